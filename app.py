@@ -1,22 +1,44 @@
 import os
+import cProfile
+import logging
+import pstats
+import random
 import requests
 import json
 import csv
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from itertools import islice
 from io import BytesIO, StringIO
-from datetime import datetime, timedelta
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from xml.sax.saxutils import escape
+import click
+import numpy as np
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context
-# ReportLab para generar PDF
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import Paragraph, SimpleDocTemplate
-# Importación necesaria para generar XLSX
-import xlsxwriter
+from requests.adapters import HTTPAdapter
+from werkzeug.http import is_resource_modified
+from flask import (Flask, render_template, request, jsonify, Response, stream_with_context, g,
+                   has_request_context)
+# ReportLab (PDF) y xlsxwriter (XLSX) se importan al exportar por primera vez (motor_pdf,
+# exportar_xlsx_stream): la mayoría de las peticiones son vistas de página y cada worker de
+# gunicorn arranca antes y ocupa menos memoria sin ellos.
 
 # Cargar variables de entorno
 load_dotenv()
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'default_secret_key')
+# Sin efecto si el servidor (p. ej. gunicorn con --log-config) ya configuró el logging
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('historial_clima')
 
 # =========================================================================
 # 1. DATOS Y CONSTANTES
@@ -58,6 +80,16 @@ DIAS_FESTIVOS_COLOMBIA_2024 = {
 }
 DIAS_SEMANA_ES = {0: 'Lunes', 1: 'Martes', 2: 'Miércoles', 3: 'Jueves', 4: 'Viernes', 5: 'Sábado', 6: 'Domingo'}
 
+# Descargas concurrentes: tamaño del pool compartido y plazo global del ranking (segundos)
+DESCARGAS_MAX_WORKERS = int(os.getenv('DESCARGAS_MAX_WORKERS', '8'))
+RANKING_PLAZO_SEGUNDOS = float(os.getenv('RANKING_PLAZO_SEGUNDOS', '25'))
+# Máximo de coordenadas por llamada multi-coordenada al archivo
+ARCHIVO_TAMAÑO_LOTE = int(os.getenv('ARCHIVO_TAMAÑO_LOTE', '10'))
+# Snapshots del ranking: vigencia del snapshot del año en curso e intervalo del refresco en segundo plano
+RANKING_SNAPSHOT_TTL = float(os.getenv('RANKING_SNAPSHOT_TTL', '21600'))
+RANKING_REFRESCO_SEGUNDOS = float(os.getenv('RANKING_REFRESCO_SEGUNDOS', '0'))
+POOL_DESCARGAS = ThreadPoolExecutor(max_workers=DESCARGAS_MAX_WORKERS, thread_name_prefix='descarga_clima')
+
 
 def agrupar_y_ordenar_tiendas(tiendas_map):
     """Agrupa las tiendas por su tipo (Shopping, Templo, etc.) y las ordena alfabéticamente."""
@@ -78,10 +110,880 @@ TIENDAS_AGRUPADAS = agrupar_y_ordenar_tiendas(TIENDAS_MAP)
 # 2. FUNCIONES DE LÓGICA DE NEGOCIO Y API (CON FILTRO DE AÑO)
 # =========================================================================
 
-def obtener_historial_climatico(lat, lon, año):
-    """Obtiene el historial climático desde el 1 de enero del año especificado
-    hasta 5 días antes de hoy."""
+# Variables diarias solicitadas al archivo de Open-Meteo (mismo orden que las columnas de la caché)
+VARIABLES_DIARIAS = ['weather_code', 'temperature_2m_max', 'temperature_2m_min', 'precipitation_sum',
+                     'wind_speed_10m_max']
+COLUMNAS_CACHE = ['weather_code', 'tmax', 'tmin', 'precipitacion', 'viento']
+
+
+def map_wmo_code(code):
+    """Traduce un código WMO de Open-Meteo a una descripción en español."""
+    if code is None: return 'Condiciones Variadas'
+    if code == 0: return "Despejado"
+    if 1 <= code <= 3: return "Mayormente Despejado a Parcialmente Nublado"
+    if 45 <= code <= 48: return "Niebla / Escarcha"
+    if 51 <= code <= 55: return "Llovizna"
+    if 61 <= code <= 65: return "Lluvia Moderada"
+    if 80 <= code <= 82: return "Aguaceros Fuertes"
+    if 95 <= code <= 96: return "Tormenta"
+    return "Condiciones Variadas"
+
+
+# -------------------------------------------------------------------------
+# Métricas e instrumentación
+# -------------------------------------------------------------------------
+# Contadores e histogramas en memoria, expuestos en /metrics con el formato de texto de
+# Prometheus. Cada worker vuelca su copia en la caché SQLite (como mucho cada
+# METRICAS_VOLCADO_SEGUNDOS) y /metrics suma las de todos los workers.
+METRICAS_VOLCADO_SEGUNDOS = float(os.getenv('METRICAS_VOLCADO_SEGUNDOS', '5'))
+METRICAS_RETENCION_SEGUNDOS = float(os.getenv('METRICAS_RETENCION_SEGUNDOS', '86400'))
+CUBETAS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DESCRIPCION_METRICAS = {
+    'clima_etapa_segundos': ('histogram', "Duración de cada etapa: archivo_http, archivo_json, cache_lectura, "
+                                          "serie, filtros, ranking, agregados, exportar_*, render."),
+    'clima_cache_total': ('counter', "Consultas a las cachés (archivo, resultados, ranking) por resultado."),
+    'clima_archivo_peticiones_total': ('counter', "Intentos de llamada al archivo de Open-Meteo por resultado."),
+    'clima_http_peticiones_total': ('counter', "Peticiones atendidas por ruta, método y código de estado."),
+    'clima_http_segundos': ('histogram', "Duración de las peticiones por ruta, hasta devolver la respuesta "
+                                         "(sin el envío de las respuestas en streaming)."),
+}
 
+
+class Metricas:
+    """Registro de contadores e histogramas por (nombre, etiquetas), seguro entre hilos."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contadores = {}
+        self._histogramas = {}  # clave -> [cubetas acumuladas..., suma, cuenta]
+
+    def contar(self, nombre, cantidad=1, **etiquetas):
+        clave = (nombre, tuple(sorted((k, str(v)) for k, v in etiquetas.items())))
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + cantidad
+
+    def observar(self, nombre, segundos, **etiquetas):
+        clave = (nombre, tuple(sorted((k, str(v)) for k, v in etiquetas.items())))
+        with self._lock:
+            histograma = self._histogramas.get(clave)
+            if histograma is None:
+                histograma = self._histogramas[clave] = [0] * len(CUBETAS_SEGUNDOS) + [0.0, 0]
+            for i, limite in enumerate(CUBETAS_SEGUNDOS):
+                if segundos <= limite:
+                    histograma[i] += 1
+            histograma[-2] += segundos
+            histograma[-1] += 1
+
+    def instantanea(self):
+        """Copia de los valores actuales en forma serializable a JSON."""
+        with self._lock:
+            return {'contadores': [[nombre, etiquetas, valor]
+                                   for (nombre, etiquetas), valor in self._contadores.items()],
+                    'histogramas': [[nombre, etiquetas, list(valores)]
+                                    for (nombre, etiquetas), valores in self._histogramas.items()]}
+
+
+METRICAS = Metricas()
+_volcado_metricas = {'ultimo': 0.0}
+
+
+@contextmanager
+def cronometrar(etapa):
+    """Mide el bloque como etapa en clima_etapa_segundos y, dentro de una petición, para Server-Timing."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracion = time.perf_counter() - inicio
+        METRICAS.observar('clima_etapa_segundos', duracion, etapa=etapa)
+        if has_request_context() and 'etapas' in g:
+            g.etapas[etapa] = g.etapas.get(etapa, 0.0) + duracion
+
+
+def medido(etapa):
+    """Decorador: mide cada llamada a la función como la etapa indicada."""
+    def decorador(funcion):
+        @wraps(funcion)
+        def envoltura(*args, **kwargs):
+            with cronometrar(etapa):
+                return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+def cronometrar_generador(etapa, generador):
+    """Mide un generador (p. ej. una exportación en streaming) desde el primer bloque hasta el último."""
+    with cronometrar(etapa):
+        yield from generador
+
+
+def volcar_metricas(forzar=False):
+    """Guarda la instantánea de este proceso en la caché compartida (como mucho cada METRICAS_VOLCADO_SEGUNDOS)."""
+    ahora = time.time()
+    if not forzar and ahora - _volcado_metricas['ultimo'] < METRICAS_VOLCADO_SEGUNDOS:
+        return
+    _volcado_metricas['ultimo'] = ahora
+    try:
+        conexion = _conexion_cache()
+        with conexion:
+            conexion.execute("INSERT OR REPLACE INTO metricas_procesos (pid, actualizado, datos) VALUES (?, ?, ?)",
+                             (os.getpid(), ahora, json.dumps(METRICAS.instantanea())))
+            conexion.execute("DELETE FROM metricas_procesos WHERE actualizado < ?",
+                             (ahora - METRICAS_RETENCION_SEGUNDOS,))
+    except sqlite3.Error as e:
+        logger.warning("No se pudieron volcar las métricas: %s", e)
+
+
+def instantaneas_procesos():
+    """Instantáneas de todos los workers: la de este proceso en vivo y las volcadas por los demás."""
+    instantaneas = [METRICAS.instantanea()]
+    try:
+        filas = _conexion_cache().execute("SELECT datos FROM metricas_procesos WHERE pid != ?",
+                                          (os.getpid(),)).fetchall()
+    except sqlite3.Error as e:
+        logger.warning("No se pudieron leer las métricas de otros workers: %s", e)
+        filas = []
+    instantaneas.extend(json.loads(fila[0]) for fila in filas)
+    return instantaneas
+
+
+def _valor_etiqueta(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _etiquetas_prometheus(etiquetas):
+    if not etiquetas:
+        return ''
+    return '{' + ','.join(f'{clave}="{_valor_etiqueta(valor)}"' for clave, valor in etiquetas) + '}'
+
+
+def _series_metrica(registro, nombre):
+    """(etiquetas, valor) de una métrica, ordenadas por etiquetas (no hay dos series con las mismas)."""
+    return sorted((clave[1], valor) for clave, valor in registro.items() if clave[0] == nombre)
+
+
+def exposicion_prometheus(instantaneas):
+    """Suma las instantáneas de varios procesos y las formatea en el formato de texto de Prometheus."""
+    contadores, histogramas = {}, {}
+    for instantanea in instantaneas:
+        for nombre, etiquetas, valor in instantanea['contadores']:
+            clave = (nombre, tuple(map(tuple, etiquetas)))
+            contadores[clave] = contadores.get(clave, 0) + valor
+        for nombre, etiquetas, valores in instantanea['histogramas']:
+            clave = (nombre, tuple(map(tuple, etiquetas)))
+            previos = histogramas.get(clave)
+            histogramas[clave] = list(valores) if previos is None else [a + b for a, b in zip(previos, valores)]
+
+    lineas = []
+    for nombre, (tipo, ayuda) in DESCRIPCION_METRICAS.items():
+        lineas.append(f"# HELP {nombre} {ayuda}")
+        lineas.append(f"# TYPE {nombre} {tipo}")
+        if tipo == 'counter':
+            for etiquetas, valor in _series_metrica(contadores, nombre):
+                lineas.append(f"{nombre}{_etiquetas_prometheus(etiquetas)} {valor}")
+            continue
+        for etiquetas, valores in _series_metrica(histogramas, nombre):
+            for limite, acumulado in zip(CUBETAS_SEGUNDOS, valores):
+                cubeta = _etiquetas_prometheus((*etiquetas, ('le', f'{limite:g}')))
+                lineas.append(f"{nombre}_bucket{cubeta} {acumulado}")
+            lineas.append(f"{nombre}_bucket{_etiquetas_prometheus((*etiquetas, ('le', '+Inf')))} {valores[-1]}")
+            lineas.append(f"{nombre}_sum{_etiquetas_prometheus(etiquetas)} {valores[-2]:.6f}")
+            lineas.append(f"{nombre}_count{_etiquetas_prometheus(etiquetas)} {valores[-1]}")
+    return '\n'.join(lineas) + '\n'
+
+
+# -------------------------------------------------------------------------
+# Serie climática columnar
+# -------------------------------------------------------------------------
+CONDICIONES = ["Despejado", "Mayormente Despejado a Parcialmente Nublado", "Niebla / Escarcha", "Llovizna",
+               "Lluvia Moderada", "Aguaceros Fuertes", "Tormenta", "Condiciones Variadas"]
+_CONDICIONES_ARRAY = np.array(CONDICIONES, dtype=object)
+_NOMBRES_DIA_ARRAY = np.array([DIAS_SEMANA_ES[i] for i in range(7)], dtype=object)
+# Tabla código WMO -> índice en CONDICIONES, precalculada una sola vez con map_wmo_code
+_INDICE_CONDICION_POR_CODIGO = np.array([CONDICIONES.index(map_wmo_code(code)) for code in range(100)],
+                                        dtype=np.int8)
+_INDICE_CONDICIONES_VARIADAS = CONDICIONES.index("Condiciones Variadas")
+
+
+class SerieClimatica:
+    """Serie diaria en columnas: un array de NumPy por variable en lugar de un dict por día.
+
+    Los valores ausentes son NaN. El día de la semana y la condición se calculan de forma
+    vectorizada a partir de las fechas y los códigos WMO; las filas en forma de dict solo se
+    generan al final, para las plantillas y exportaciones (a_filas)."""
+
+    __slots__ = ('fechas', 'tmax', 'tmin', 'precipitacion', 'viento', 'codigo')
+
+    def __init__(self, fechas, tmax, tmin, precipitacion, viento, codigo):
+        self.fechas = fechas
+        self.tmax = tmax
+        self.tmin = tmin
+        self.precipitacion = precipitacion
+        self.viento = viento
+        self.codigo = codigo
+
+    @classmethod
+    @medido('serie')
+    def desde_diario(cls, daily_data):
+        """Construye la serie a partir del bloque 'daily' de la API (o de la caché)."""
+        fechas = np.array(daily_data.get('time') or [], dtype='datetime64[D]')
+        n = len(fechas)
+
+        def columna(clave):
+            valores = np.array(daily_data.get(clave) or [], dtype=float)
+            if len(valores) < n:
+                # Una variable más corta que 'time' se completa con NaN, como hacía el acceso por índice
+                valores = np.concatenate([valores, np.full(n - len(valores), np.nan)])
+            return valores[:n]
+
+        return cls(fechas, columna('temperature_2m_max'), columna('temperature_2m_min'),
+                   columna('precipitation_sum'), columna('wind_speed_10m_max'), columna('weather_code'))
+
+    @classmethod
+    def vacia(cls):
+        return cls.desde_diario({})
+
+    @classmethod
+    def concatenar(cls, series):
+        """Une varias series (p. ej. varios años o tiendas) en una sola, en el orden dado."""
+        series = list(series)
+        if not series:
+            return cls.vacia()
+        return cls(*(np.concatenate([getattr(s, campo) for s in series]) for campo in cls.__slots__))
+
+    def __len__(self):
+        return len(self.fechas)
+
+    def seleccionar(self, seleccion):
+        """Devuelve una nueva serie con los días indicados por una máscara booleana o índices."""
+        return SerieClimatica(*(getattr(self, campo)[seleccion] for campo in self.__slots__))
+
+    @property
+    def dia_semana(self):
+        """Día de la semana (0 = lunes), calculado sobre los días desde la época (1970-01-01 fue jueves)."""
+        return (self.fechas.astype('int64') + 3) % 7
+
+    @property
+    def indice_condicion(self):
+        """Índice en CONDICIONES de cada día; los códigos ausentes o desconocidos son 'Condiciones Variadas'."""
+        codigos = self.codigo
+        validos = ~np.isnan(codigos) & (codigos >= 0) & (codigos < len(_INDICE_CONDICION_POR_CODIGO))
+        indices = np.full(len(codigos), _INDICE_CONDICIONES_VARIADAS, dtype=np.int8)
+        indices[validos] = _INDICE_CONDICION_POR_CODIGO[codigos[validos].astype(np.int64)]
+        return indices
+
+    @property
+    def condiciones(self):
+        return _CONDICIONES_ARRAY[self.indice_condicion]
+
+    @property
+    def nombres_dia(self):
+        return _NOMBRES_DIA_ARRAY[self.dia_semana]
+
+    def a_bytes(self):
+        """Serializa las columnas en formato .npy comprimido (para la caché de resultados)."""
+        buffer = BytesIO()
+        np.savez_compressed(buffer, **{campo: getattr(self, campo) for campo in self.__slots__})
+        return buffer.getvalue()
+
+    @classmethod
+    def desde_bytes(cls, datos):
+        with np.load(BytesIO(datos), allow_pickle=False) as columnas:
+            return cls(*(columnas[campo] for campo in cls.__slots__))
+
+    def a_columnas(self):
+        """Columnas como listas de Python (NaN -> None), con las mismas claves que las filas de a_filas."""
+        tmax, tmin, precip, viento = (np.where(np.isnan(col), None, col).tolist()
+                                      for col in (self.tmax, self.tmin, self.precipitacion, self.viento))
+        return {
+            'fecha': np.datetime_as_string(self.fechas, unit='D').tolist(),
+            'nombre_dia': self.nombres_dia.tolist(),
+            'tmax': tmax,
+            'tmin': tmin,
+            'precipitacion_mm': precip,
+            'viento_kmh': viento,
+            'condiciones': self.condiciones.tolist(),
+        }
+
+    def a_filas(self):
+        """Convierte la serie en la lista de dicts por día que usan las plantillas y exportaciones."""
+        columnas = self.a_columnas()
+        return [{
+            'fecha': columnas['fecha'][i],
+            'nombre_dia': columnas['nombre_dia'][i],
+            'tmax': columnas['tmax'][i],
+            'tmin': columnas['tmin'][i],
+            'precipitacion_mm': columnas['precipitacion_mm'][i],
+            'viento_kmh': columnas['viento_kmh'][i],
+            'nubosidad_perc': 50,  # Dato simulado
+            'condiciones': columnas['condiciones'][i],
+        } for i in range(len(self))]
+
+
+# -------------------------------------------------------------------------
+# Cliente HTTP del archivo (sesión compartida, reintentos y cortacircuitos)
+# -------------------------------------------------------------------------
+ARCHIVO_URL = os.getenv('OPEN_METEO_ARCHIVE_URL', 'https://archive-api.open-meteo.com/v1/archive')
+ARCHIVO_TIMEOUT = float(os.getenv('ARCHIVO_TIMEOUT', '15'))
+ARCHIVO_POOL_CONEXIONES = int(os.getenv('ARCHIVO_POOL_CONEXIONES', '16'))
+ARCHIVO_REINTENTOS = int(os.getenv('ARCHIVO_REINTENTOS', '3'))
+ARCHIVO_BACKOFF_BASE = float(os.getenv('ARCHIVO_BACKOFF_BASE', '0.5'))
+ARCHIVO_BACKOFF_MAX = float(os.getenv('ARCHIVO_BACKOFF_MAX', '8'))
+CIRCUITO_UMBRAL_FALLOS = int(os.getenv('CIRCUITO_UMBRAL_FALLOS', '5'))
+CIRCUITO_ENFRIAMIENTO = float(os.getenv('CIRCUITO_ENFRIAMIENTO', '30'))
+ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+
+class CircuitoAbierto(requests.exceptions.RequestException):
+    """El cortacircuitos está abierto: no se llama al archivo hasta que pase el enfriamiento."""
+
+
+def _segundos_retry_after(response):
+    """Interpreta la cabecera Retry-After (segundos o fecha HTTP); None si no viene o no es válida."""
+    valor = response.headers.get('Retry-After')
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class ClienteArchivo:
+    """Cliente del archivo de Open-Meteo con conexiones persistentes, reintentos y cortacircuitos.
+
+    Una sola instancia por proceso reutiliza las conexiones TCP/TLS entre peticiones e hilos.
+    Los 429/5xx y errores de red se reintentan con backoff exponencial (respetando Retry-After);
+    tras CIRCUITO_UMBRAL_FALLOS fallos seguidos el circuito se abre y las llamadas fallan al
+    instante durante CIRCUITO_ENFRIAMIENTO segundos."""
+
+    def __init__(self, url=ARCHIVO_URL, pool_conexiones=ARCHIVO_POOL_CONEXIONES, reintentos=ARCHIVO_REINTENTOS,
+                 timeout=ARCHIVO_TIMEOUT, umbral_fallos=CIRCUITO_UMBRAL_FALLOS, enfriamiento=CIRCUITO_ENFRIAMIENTO):
+        self.url = url
+        self.reintentos = reintentos
+        self.timeout = timeout
+        self.umbral_fallos = umbral_fallos
+        self.enfriamiento = enfriamiento
+        self.sesion = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=pool_conexiones, pool_maxsize=pool_conexiones, max_retries=0)
+        self.sesion.mount('https://', adaptador)
+        self.sesion.mount('http://', adaptador)
+        self._lock = threading.Lock()
+        self._fallos_seguidos = 0
+        self._abierto_hasta = 0.0
+
+    def _espera_backoff(self, intento):
+        # Backoff exponencial con jitter para que los workers no reintenten a la vez
+        return min(ARCHIVO_BACKOFF_MAX, ARCHIVO_BACKOFF_BASE * 2 ** intento) * random.uniform(0.5, 1.0)
+
+    def _verificar_circuito(self):
+        with self._lock:
+            restante = self._abierto_hasta - time.monotonic()
+        if restante > 0:
+            raise CircuitoAbierto(f"Servicio de clima no disponible temporalmente; reintente en {restante:.0f} s.")
+
+    def _registrar_exito(self):
+        with self._lock:
+            self._fallos_seguidos = 0
+            self._abierto_hasta = 0.0
+
+    def _registrar_fallo(self):
+        with self._lock:
+            self._fallos_seguidos += 1
+            if self._fallos_seguidos >= self.umbral_fallos:
+                self._abierto_hasta = time.monotonic() + self.enfriamiento
+
+    def get_json(self, params):
+        """GET al archivo con los parámetros dados; devuelve el JSON o lanza una excepción de requests."""
+        try:
+            self._verificar_circuito()
+        except CircuitoAbierto:
+            METRICAS.contar('clima_archivo_peticiones_total', resultado='circuito_abierto')
+            raise
+        error = None
+        for intento in range(self.reintentos + 1):
+            try:
+                with cronometrar('archivo_http'):
+                    response = self.sesion.get(self.url, params=params, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                METRICAS.contar('clima_archivo_peticiones_total', resultado='error_red')
+                error, espera = e, self._espera_backoff(intento)
+            else:
+                if response.status_code not in ESTADOS_REINTENTABLES:
+                    # Un 4xx es un error de la consulta, no del servicio: no cuenta para el circuito
+                    self._registrar_exito()
+                    METRICAS.contar('clima_archivo_peticiones_total',
+                                    resultado='ok' if response.ok else 'error_consulta')
+                    response.raise_for_status()
+                    with cronometrar('archivo_json'):
+                        return response.json()
+                METRICAS.contar('clima_archivo_peticiones_total', resultado='error_servicio')
+                error = requests.exceptions.HTTPError(f"{response.status_code} en el archivo", response=response)
+                espera = _segundos_retry_after(response)
+                if espera is None:
+                    espera = self._espera_backoff(intento)
+                elif espera > ARCHIVO_BACKOFF_MAX:
+                    # El servidor pide esperar más de lo que una petición web puede aguantar
+                    break
+            if intento < self.reintentos:
+                time.sleep(espera)
+        self._registrar_fallo()
+        raise error
+
+
+CLIENTE_ARCHIVO = ClienteArchivo()
+
+
+# -------------------------------------------------------------------------
+# Caché persistente del archivo climático (SQLite)
+# -------------------------------------------------------------------------
+# Un día ya publicado en el archivo no cambia, así que cada (coordenada, fecha) se guarda
+# una sola vez: los años cerrados quedan cacheados para siempre y el año en curso solo
+# descarga los días posteriores al último almacenado.
+CACHE_DB_PATH = os.getenv('CLIMA_CACHE_DB', os.path.join(app.instance_path, 'clima_cache.sqlite3'))
+_cache_local = threading.local()
+
+
+def _conexion_cache():
+    """Devuelve la conexión SQLite del hilo actual, creando el esquema la primera vez."""
+    conexion = getattr(_cache_local, 'conexion', None)
+    if conexion is None:
+        os.makedirs(os.path.dirname(os.path.abspath(CACHE_DB_PATH)), exist_ok=True)
+        conexion = sqlite3.connect(CACHE_DB_PATH, timeout=30)
+        # WAL permite lecturas concurrentes desde varios workers de gunicorn mientras otro escribe
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute("PRAGMA synchronous=NORMAL")
+        conexion.execute("""CREATE TABLE IF NOT EXISTS dias_clima (
+                                lat REAL NOT NULL, lon REAL NOT NULL, fecha TEXT NOT NULL,
+                                weather_code INTEGER, tmax REAL, tmin REAL, precipitacion REAL, viento REAL,
+                                PRIMARY KEY (lat, lon, fecha)) WITHOUT ROWID""")
+        conexion.execute("""CREATE TABLE IF NOT EXISTS ranking_snapshots (
+                                año INTEGER PRIMARY KEY, generado_en TEXT NOT NULL, datos TEXT NOT NULL)""")
+        conexion.execute("""CREATE TABLE IF NOT EXISTS resultados (
+                                clave TEXT PRIMARY KEY, creado REAL NOT NULL, accedido REAL NOT NULL,
+                                tienda TEXT NOT NULL, año TEXT NOT NULL, datos BLOB NOT NULL,
+                                cerrado INTEGER NOT NULL DEFAULT 0)""")
+        if 'cerrado' not in {columna[1] for columna in conexion.execute("PRAGMA table_info(resultados)")}:
+            # Bases anteriores a la columna: sus resultados cuentan como no cerrados
+            try:
+                conexion.execute("ALTER TABLE resultados ADD COLUMN cerrado INTEGER NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass  # otro worker la añadió a la vez
+        conexion.execute("CREATE INDEX IF NOT EXISTS resultados_accedido ON resultados (accedido)")
+        conexion.execute("""CREATE TABLE IF NOT EXISTS vuelos (
+                                clave TEXT PRIMARY KEY, estado TEXT NOT NULL, expira REAL NOT NULL)""")
+        conexion.execute("""CREATE TABLE IF NOT EXISTS celdas_archivo (
+                                lat REAL NOT NULL, lon REAL NOT NULL, celda_lat REAL NOT NULL, celda_lon REAL NOT NULL,
+                                PRIMARY KEY (lat, lon)) WITHOUT ROWID""")
+        conexion.execute("""CREATE TABLE IF NOT EXISTS metricas_procesos (
+                                pid INTEGER PRIMARY KEY, actualizado REAL NOT NULL, datos TEXT NOT NULL)""")
+        conexion.commit()
+        _cache_local.conexion = conexion
+    return conexion
+
+
+def _clave_coordenada(lat, lon):
+    """Normaliza la coordenada usada como clave de la caché."""
+    return round(float(lat), 5), round(float(lon), 5)
+
+
+@medido('cache_lectura')
+def leer_cache_diaria(lat, lon, fecha_inicio, fecha_fin):
+    """Lee de la caché los días almacenados en el rango, con el mismo formato que 'daily' de la API."""
+    lat_c, lon_c = _clave_coordenada(lat, lon)
+    filas = _conexion_cache().execute(
+        f"SELECT fecha, {', '.join(COLUMNAS_CACHE)} FROM dias_clima "
+        f"WHERE lat = ? AND lon = ? AND fecha BETWEEN ? AND ? ORDER BY fecha",
+        (lat_c, lon_c, fecha_inicio, fecha_fin)).fetchall()
+    diario = {'time': [fila[0] for fila in filas]}
+    for i, variable in enumerate(VARIABLES_DIARIAS, start=1):
+        diario[variable] = [fila[i] for fila in filas]
+    return diario
+
+
+def guardar_cache_diaria(lat, lon, diario):
+    """Guarda en la caché los días descargados.
+
+    Los días finales sin ningún valor aún no están publicados en el archivo y no se guardan,
+    para que la siguiente consulta los vuelva a pedir."""
+    times = diario.get('time', [])
+    columnas = [diario.get(v) or [] for v in VARIABLES_DIARIAS]
+    filas = []
+    for i, fecha in enumerate(times):
+        valores = [col[i] if i < len(col) else None for col in columnas]
+        filas.append((fecha, *valores))
+    while filas and all(v is None for v in filas[-1][1:]):
+        filas.pop()
+    if not filas:
+        return 0
+    lat_c, lon_c = _clave_coordenada(lat, lon)
+    conexion = _conexion_cache()
+    with conexion:
+        conexion.executemany(
+            f"INSERT OR REPLACE INTO dias_clima (lat, lon, fecha, {', '.join(COLUMNAS_CACHE)}) "
+            f"VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(lat_c, lon_c, *fila) for fila in filas])
+    return len(filas)
+
+
+# -------------------------------------------------------------------------
+# Celdas de la rejilla del archivo
+# -------------------------------------------------------------------------
+# El archivo sirve datos de una rejilla de ~10 km, así que tiendas a pocos metros reciben la
+# misma serie. Cada tienda se asigna a su celda y solo se descarga y se guarda en caché la
+# coordenada representativa de la celda (la de la primera tienda de TIENDAS_MAP que cae en ella).
+# La celda de cada coordenada es la que devuelve la propia API (latitude/longitude de cada
+# ubicación): se aprende de cada respuesta y se guarda en la caché, y la primera vez que hace
+# falta se descubre la de todas las tiendas con una consulta de un solo día. Mientras no se
+# conozca, solo se agrupan coordenadas idénticas (o, con CELDA_GRADOS > 0, las que caen en la
+# misma celda de una rejilla fija, que no reproduce la de la API).
+# Aun dentro de una celda la API ajusta la temperatura a la elevación de cada coordenada, así
+# que agrupar supone aceptar la serie de la tienda representativa para sus vecinas.
+CELDA_GRADOS = float(os.getenv('CELDA_GRADOS', '0'))
+CELDAS_REINTENTO_SEGUNDOS = float(os.getenv('CELDAS_REINTENTO_SEGUNDOS', '300'))
+_CELDAS_INDEXADAS = {}
+REPRESENTANTES_CELDA = {}
+_celdas_lock = threading.RLock()
+_celdas_estado = {'completo': False, 'proximo_intento': 0.0}
+
+
+def celda_de(lat, lon):
+    """Celda del archivo de una coordenada: la aprendida de la API si se conoce, si no la propia coordenada
+    (o su celda en la rejilla de CELDA_GRADOS, si está configurada)."""
+    celda = _CELDAS_INDEXADAS.get(_clave_coordenada(lat, lon))
+    if celda is not None:
+        return celda
+    if CELDA_GRADOS <= 0:
+        # Sin rejilla solo se agrupan las coordenadas idénticas
+        return _clave_coordenada(lat, lon)
+    return (round(round(lat / CELDA_GRADOS) * CELDA_GRADOS, 5), round(round(lon / CELDA_GRADOS) * CELDA_GRADOS, 5))
+
+
+def _actualizar_celdas(indexadas):
+    """Publica un índice de celdas nuevo y recalcula la coordenada representativa de cada celda.
+
+    Los dicts se reemplazan enteros para que los hilos que los leen nunca vean uno a medio armar."""
+    global _CELDAS_INDEXADAS, REPRESENTANTES_CELDA
+    _CELDAS_INDEXADAS = indexadas
+    representantes = {}
+    for lat, lon in TIENDAS_MAP.values():
+        representantes.setdefault(celda_de(lat, lon), (lat, lon))
+    REPRESENTANTES_CELDA = representantes
+    _celdas_estado['completo'] = all(_clave_coordenada(lat, lon) in indexadas for lat, lon in TIENDAS_MAP.values())
+
+
+def cargar_indice_celdas():
+    """Carga de la caché las celdas aprendidas (por cualquier worker) y recalcula las representativas."""
+    filas = _conexion_cache().execute("SELECT lat, lon, celda_lat, celda_lon FROM celdas_archivo").fetchall()
+    with _celdas_lock:
+        _actualizar_celdas({(lat, lon): (celda_lat, celda_lon) for lat, lon, celda_lat, celda_lon in filas})
+
+
+def registrar_celdas(coordenadas, ubicaciones):
+    """Guarda la celda que la API usó para cada coordenada consultada (si cambió o es nueva)."""
+    nuevas = {}
+    for (lat, lon), ubicacion in zip(coordenadas, ubicaciones):
+        if 'latitude' not in ubicacion or 'longitude' not in ubicacion:
+            continue
+        clave = _clave_coordenada(lat, lon)
+        celda = (round(float(ubicacion['latitude']), 5), round(float(ubicacion['longitude']), 5))
+        if _CELDAS_INDEXADAS.get(clave) != celda:
+            nuevas[clave] = celda
+    if not nuevas:
+        return
+    try:
+        conexion = _conexion_cache()
+        with conexion:
+            conexion.executemany("INSERT OR REPLACE INTO celdas_archivo (lat, lon, celda_lat, celda_lon) "
+                                 "VALUES (?, ?, ?, ?)", [(*clave, *celda) for clave, celda in nuevas.items()])
+    except sqlite3.Error as e:
+        logger.warning("No se pudieron guardar las celdas del archivo: %s", e)
+    with _celdas_lock:
+        _actualizar_celdas({**_CELDAS_INDEXADAS, **nuevas})
+
+
+def descubrir_celdas(forzar=False):
+    """Pregunta al archivo la celda de las tiendas que aún no la tienen (todas con forzar=True).
+
+    Un solo día basta: solo interesa la coordenada de celda de cada ubicación de la respuesta."""
+    coordenadas = [coordenada for coordenada in dict.fromkeys(TIENDAS_MAP.values())
+                   if forzar or _clave_coordenada(*coordenada) not in _CELDAS_INDEXADAS]
+    fecha = f"{año_con_datos()}-01-01"
+    for inicio in range(0, len(coordenadas), ARCHIVO_TAMAÑO_LOTE):
+        # consultar_archivo_lote registra las celdas de la respuesta
+        consultar_archivo_lote(coordenadas[inicio:inicio + ARCHIVO_TAMAÑO_LOTE], fecha, fecha)
+
+
+def asegurar_indice_celdas():
+    """Completa el índice de celdas antes de la primera descarga del proceso.
+
+    Primero se lee lo que ya aprendieron otros workers; si faltan tiendas se consulta al archivo.
+    Si el archivo no responde se sigue sin agrupar y se reintenta tras CELDAS_REINTENTO_SEGUNDOS."""
+    if _celdas_estado['completo'] or time.monotonic() < _celdas_estado['proximo_intento']:
+        return
+    with _celdas_lock:
+        if _celdas_estado['completo'] or time.monotonic() < _celdas_estado['proximo_intento']:
+            return
+        try:
+            cargar_indice_celdas()
+            if not _celdas_estado['completo']:
+                descubrir_celdas()
+        except Exception as e:
+            logger.warning("No se pudieron obtener las celdas del archivo; se reintenta en %g s: %s",
+                           CELDAS_REINTENTO_SEGUNDOS, e)
+        if not _celdas_estado['completo']:
+            _celdas_estado['proximo_intento'] = time.monotonic() + CELDAS_REINTENTO_SEGUNDOS
+
+
+def coordenada_archivo(lat, lon):
+    """Coordenada con la que se descarga y se cachea el archivo para (lat, lon): la representativa de su celda."""
+    asegurar_indice_celdas()
+    return REPRESENTANTES_CELDA.get(celda_de(lat, lon), (lat, lon))
+
+
+def agrupar_por_celda(tiendas_map):
+    """Agrupa {tienda: (lat, lon)} en {coordenada representativa: [tiendas]}, en el orden del mapa."""
+    por_celda = {}
+    for nombre, (lat, lon) in tiendas_map.items():
+        por_celda.setdefault(coordenada_archivo(lat, lon), []).append(nombre)
+    return por_celda
+
+
+def purgar_cache_celdas():
+    """Borra de la caché los días guardados para tiendas que ya no son la representativa de su celda."""
+    sobrantes = {_clave_coordenada(lat, lon) for lat, lon in TIENDAS_MAP.values()} - {
+        _clave_coordenada(lat, lon) for lat, lon in REPRESENTANTES_CELDA.values()}
+    conexion = _conexion_cache()
+    with conexion:
+        return sum(conexion.execute("DELETE FROM dias_clima WHERE lat = ? AND lon = ?", clave).rowcount
+                   for clave in sobrantes)
+
+
+_actualizar_celdas({})
+
+
+# -------------------------------------------------------------------------
+# Coalescencia de descargas (single-flight)
+# -------------------------------------------------------------------------
+# Cada rango pendiente (coordenada, desde, hasta) lo descarga un solo hilo en todo el
+# despliegue. Dentro del proceso, los demás hilos esperan un Event. Entre workers de
+# gunicorn se usa un arrendamiento en la tabla 'vuelos' de la base SQLite compartida. Al
+# terminar, el rango queda marcado como revisado durante ARCHIVO_REVISION_TTL, de modo que
+# los días que el archivo aún no publica no se vuelven a pedir en cada consulta.
+VUELO_ARRENDAMIENTO_SEGUNDOS = float(os.getenv('VUELO_ARRENDAMIENTO_SEGUNDOS', '60'))
+ARCHIVO_REVISION_TTL = float(os.getenv('ARCHIVO_REVISION_TTL', '3600'))
+_vuelos_locales = {}  # clave -> threading.Event del hilo que descarga en este proceso
+_vuelos_lock = threading.Lock()
+
+
+def clave_vuelo(lat, lon, desde, hasta):
+    lat_c, lon_c = _clave_coordenada(lat, lon)
+    return f"{lat_c},{lon_c},{desde},{hasta}"
+
+
+def _soltar_vuelo_local(clave):
+    with _vuelos_lock:
+        evento = _vuelos_locales.pop(clave, None)
+    if evento is not None:
+        evento.set()
+
+
+def esperar_vuelo(clave, plazo=VUELO_ARRENDAMIENTO_SEGUNDOS):
+    """Espera a que termine la descarga en curso de la clave (en este proceso o en otro worker)."""
+    with _vuelos_lock:
+        evento = _vuelos_locales.get(clave)
+    if evento is not None:
+        evento.wait(plazo)
+        return
+    limite = time.monotonic() + plazo
+    while time.monotonic() < limite:
+        fila = _conexion_cache().execute("SELECT estado, expira FROM vuelos WHERE clave = ?", (clave,)).fetchone()
+        if fila is None or fila[0] != 'descargando' or fila[1] < time.time():
+            return
+        time.sleep(0.1)
+
+
+def iniciar_vuelo(clave, esperar=True):
+    """Intenta quedarse con la descarga de la clave.
+
+    Devuelve 'lider' si este hilo debe descargar (y luego llamar a terminar_vuelo), 'hecho' si
+    otro hilo o worker ya la hizo (o se esperó a que la hiciera) y 'en_curso' si otro la está
+    haciendo y esperar=False."""
+    with _vuelos_lock:
+        ocupado_en_proceso = clave in _vuelos_locales
+        if not ocupado_en_proceso:
+            _vuelos_locales[clave] = threading.Event()
+    if ocupado_en_proceso:
+        if not esperar:
+            return 'en_curso'
+        esperar_vuelo(clave)
+        return 'hecho'
+
+    ahora = time.time()
+    try:
+        conexion = _conexion_cache()
+        with conexion:
+            cursor = conexion.execute(
+                "INSERT INTO vuelos (clave, estado, expira) VALUES (?, 'descargando', ?) "
+                "ON CONFLICT(clave) DO UPDATE SET estado = 'descargando', expira = excluded.expira "
+                "WHERE vuelos.expira < ?", (clave, ahora + VUELO_ARRENDAMIENTO_SEGUNDOS, ahora))
+        if cursor.rowcount == 1:
+            return 'lider'
+        fila = conexion.execute("SELECT estado FROM vuelos WHERE clave = ?", (clave,)).fetchone()
+    except sqlite3.Error as e:
+        # Sin coordinación entre workers se descarga igualmente: solo se pierde la deduplicación
+        logger.warning("No se pudo coordinar la descarga %s: %s", clave, e)
+        return 'lider'
+
+    # Otro worker tiene el arrendamiento (descargando o revisado hace poco)
+    _soltar_vuelo_local(clave)
+    if fila is not None and fila[0] == 'descargando':
+        if not esperar:
+            return 'en_curso'
+        esperar_vuelo(clave)
+    return 'hecho'
+
+
+def terminar_vuelo(clave, exito, revisadas=()):
+    """Libera la clave; si la descarga fue bien, la marca (junto con 'revisadas') como revisada."""
+    ahora = time.time()
+    try:
+        conexion = _conexion_cache()
+        with conexion:
+            if exito:
+                conexion.executemany(
+                    "INSERT OR REPLACE INTO vuelos (clave, estado, expira) VALUES (?, 'hecho', ?)",
+                    [(c, ahora + ARCHIVO_REVISION_TTL) for c in (clave, *revisadas)])
+            else:
+                conexion.execute("DELETE FROM vuelos WHERE clave = ?", (clave,))
+            conexion.execute("DELETE FROM vuelos WHERE expira < ?", (ahora,))
+    except sqlite3.Error as e:
+        logger.warning("No se pudo liberar la descarga %s: %s", clave, e)
+    finally:
+        _soltar_vuelo_local(clave)
+
+
+def _unir_diarios(base, extra):
+    """Concatena dos bloques 'daily' consecutivos."""
+    return {clave: list(base.get(clave) or []) + list(extra.get(clave) or []) for clave in ['time', *VARIABLES_DIARIAS]}
+
+
+def consultar_archivo_lote(coordenadas, fecha_inicio, fecha_fin):
+    """Consulta en una sola llamada al archivo de Open-Meteo varias coordenadas y devuelve sus ubicaciones.
+
+    La API acepta listas separadas por comas en latitude/longitude y responde con una lista
+    de objetos en el mismo orden (o un único objeto si solo se pide una coordenada), cada uno
+    con la coordenada de la celda de rejilla usada y su bloque 'daily'."""
+    params = {
+        'latitude': ','.join(str(lat) for lat, _ in coordenadas),
+        'longitude': ','.join(str(lon) for _, lon in coordenadas),
+        'start_date': fecha_inicio, 'end_date': fecha_fin,
+        'daily': ','.join(VARIABLES_DIARIAS),
+        'temperature_unit': 'celsius', 'wind_speed_unit': 'kmh', 'precipitation_unit': 'mm', 'timezone': 'auto',
+    }
+    data = CLIENTE_ARCHIVO.get_json(params)
+    if isinstance(data, dict):
+        data = [data]
+    if len(data) != len(coordenadas):
+        raise ValueError(f"La API devolvió {len(data)} ubicaciones para {len(coordenadas)} coordenadas.")
+    registrar_celdas(coordenadas, data)
+    return data
+
+
+def descargar_diario_lote(coordenadas, fecha_inicio, fecha_fin):
+    """Descarga en una sola llamada al archivo el bloque 'daily' de varias coordenadas."""
+    return [ubicacion.get('daily', {}) for ubicacion in consultar_archivo_lote(coordenadas, fecha_inicio, fecha_fin)]
+
+
+def descargar_diario(lat, lon, fecha_inicio, fecha_fin):
+    """Descarga del archivo de Open-Meteo el bloque 'daily' de una coordenada y rango."""
+    return descargar_diario_lote([(lat, lon)], fecha_inicio, fecha_fin)[0]
+
+
+def _pendiente_cache(lat, lon, fecha_inicio, fecha_fin):
+    """Devuelve (almacenado, desde): lo que hay en caché y la fecha desde la que falta descargar (o None)."""
+    almacenado = leer_cache_diaria(lat, lon, fecha_inicio, fecha_fin)
+    ultima_fecha = almacenado['time'][-1] if almacenado['time'] else None
+    if ultima_fecha is None:
+        return almacenado, fecha_inicio
+    if ultima_fecha >= fecha_fin:
+        return almacenado, None
+    return almacenado, (datetime.strptime(ultima_fecha, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def _contar_cache_archivo(almacenado, desde):
+    """Acierto si el rango estaba completo en caché, parcial si faltaban días al final, fallo si no había nada."""
+    resultado = 'acierto' if desde is None else 'parcial' if almacenado['time'] else 'fallo'
+    METRICAS.contar('clima_cache_total', cache='archivo', resultado=resultado)
+
+
+def _revisiones_pendientes(lat, lon, diario, fecha_fin):
+    """Clave del rango que sigue pendiente tras guardar 'diario' (días aún no publicados), si lo hay."""
+    fechas = diario.get('time') or []
+    if not fechas or fechas[-1] >= fecha_fin:
+        return ()
+    _, desde = _pendiente_cache(lat, lon, fechas[0], fecha_fin)
+    return (clave_vuelo(lat, lon, desde, fecha_fin),) if desde is not None else ()
+
+
+DESCARGA_AJENA_SIN_DATOS = "La descarga del mismo rango en otro proceso no dejó datos en la caché; vuelva a intentarlo."
+
+
+def obtener_diario_cacheado(lat, lon, fecha_inicio, fecha_fin):
+    """Devuelve el bloque 'daily' del rango, descargando solo los días que faltan en la caché.
+
+    Si otro hilo o worker ya está descargando (o acaba de revisar) el mismo rango, se espera
+    y se usa lo que dejó en la caché en lugar de repetir la llamada."""
+    almacenado, desde = _pendiente_cache(lat, lon, fecha_inicio, fecha_fin)
+    _contar_cache_archivo(almacenado, desde)
+    if desde is None:
+        return almacenado
+    clave = clave_vuelo(lat, lon, desde, fecha_fin)
+    if iniciar_vuelo(clave) != 'lider':
+        almacenado, desde = _pendiente_cache(lat, lon, fecha_inicio, fecha_fin)
+        # Si el otro hilo falló y no dejó nada, se intenta una vez más como líder
+        if desde is None or almacenado['time']:
+            return almacenado
+        clave = clave_vuelo(lat, lon, desde, fecha_fin)
+        if iniciar_vuelo(clave) != 'lider':
+            almacenado = leer_cache_diaria(lat, lon, fecha_inicio, fecha_fin)
+            if not almacenado['time']:
+                raise TimeoutError(DESCARGA_AJENA_SIN_DATOS)
+            return almacenado
+
+    exito = False
+    revisadas = ()
+    try:
+        nuevos = descargar_diario(lat, lon, desde, fecha_fin)
+        guardar_cache_diaria(lat, lon, nuevos)
+        exito = True
+        revisadas = _revisiones_pendientes(lat, lon, nuevos, fecha_fin)
+    except requests.exceptions.RequestException as e:
+        if not almacenado['time']:
+            raise
+        # Con datos parciales en caché es preferible mostrarlos que fallar por completo
+        logger.warning("No se pudo actualizar la caché para (%s, %s) desde %s: %s", lat, lon, desde, e)
+        return almacenado
+    finally:
+        terminar_vuelo(clave, exito, revisadas)
+    return _unir_diarios(almacenado, nuevos)
+
+
+# El archivo publica los días con unos 5 días de retraso
+RETRASO_ARCHIVO_DIAS = 5
+
+
+def año_con_datos():
+    """Año más reciente con días publicados: el anterior durante los primeros días de enero."""
+    return (datetime.now() - timedelta(days=RETRASO_ARCHIVO_DIAS)).year
+
+
+def rango_fechas_año(año):
+    """Valida el año y devuelve (fecha_inicio, fecha_fin) consultables, o un dict de error."""
     try:
         año_int = int(año)
     except ValueError:
@@ -90,17 +992,17 @@ def obtener_historial_climatico(lat, lon, año):
     fecha_inicio = f"{año_int}-01-01"
 
     hoy = datetime.now()
-    fecha_fin_dt = hoy - timedelta(days=5)
+    fecha_fin_dt = hoy - timedelta(days=RETRASO_ARCHIVO_DIAS)
     fecha_fin = fecha_fin_dt.strftime('%Y-%m-%d')
 
     # Ajuste de rango de fechas si el año consultado es posterior al actual
     if datetime.strptime(fecha_inicio, '%Y-%m-%d') > fecha_fin_dt:
         if año_int == hoy.year:
-            # Si es el año actual, ajusta la fecha fin a lo disponible
-            pass
-        else:
-            # Si el año es futuro o el rango es inválido, retorna error
-            return {"error": f"Rango de fechas inválido. No hay datos disponibles para el año {año_int}."}
+            # Del 1 al 5 de enero el año en curso aún no tiene días publicados (el rango quedaría invertido)
+            return {"error": f"Aún no hay días publicados del año {año_int}; el archivo va "
+                             f"{RETRASO_ARCHIVO_DIAS} días atrasado."}
+        # Si el año es futuro o el rango es inválido, retorna error
+        return {"error": f"Rango de fechas inválido. No hay datos disponibles para el año {año_int}."}
 
     # Si el año consultado es anterior al actual, se usa el fin de año del año consultado
     if año_int < hoy.year:
@@ -110,182 +1012,807 @@ def obtener_historial_climatico(lat, lon, año):
     if año_int < 2015 or año_int > hoy.year:
         return {"error": f"Consulta limitada al rango 2015-{hoy.year}."}
 
-    url = (f"https://archive-api.open-meteo.com/v1/archive?"
-           f"latitude={lat}&longitude={lon}&start_date={fecha_inicio}&end_date={fecha_fin}"
-           f"&daily=weather_code,temperature_2m_max,temperature_2m_min,precipitation_sum,wind_speed_10m_max"
-           f"&temperature_unit=celsius&wind_speed_unit=kmh&precipitation_unit=mm&timezone=auto")
+    return fecha_inicio, fecha_fin
 
-    try:
-        response = requests.get(url, timeout=15)
-        response.raise_for_status()
-        data = response.json()
-        daily_data = data.get('daily', {})
-        times = daily_data.get('time', [])
-        if not times: return []
-        datos_procesados = []
-
-        def map_wmo_code(code):
-            if code is None: return 'Condiciones Variadas'
-            if code == 0: return "Despejado"
-            if 1 <= code <= 3: return "Mayormente Despejado a Parcialmente Nublado"
-            if 45 <= code <= 48: return "Niebla / Escarcha"
-            if 51 <= code <= 55: return "Llovizna"
-            if 61 <= code <= 65: return "Lluvia Moderada"
-            if 80 <= code <= 82: return "Aguaceros Fuertes"
-            if 95 <= code <= 96: return "Tormenta"
-            return "Condiciones Variadas"
-
-        tmax_list, tmin_list, precip_list, viento_list, code_list = (daily_data.get(k, []) for k in
-                                                                     ['temperature_2m_max', 'temperature_2m_min',
-                                                                      'precipitation_sum', 'wind_speed_10m_max',
-                                                                      'weather_code'])
-
-        for i, fecha_str in enumerate(times):
-            try:
-                fecha_dt = datetime.strptime(fecha_str, '%Y-%m-%d')
-                nombre_dia = DIAS_SEMANA_ES.get(fecha_dt.weekday(), '-')
-            except ValueError:
-                nombre_dia = '-'
-
-            # >>> Lógica de festivos eliminada <<<
-
-            datos_dia = {
-                'fecha': fecha_str,
-                'nombre_dia': nombre_dia,
-                # 'es_festivo' y 'nombre_festivo' eliminados
-                'tmax': tmax_list[i] if i < len(tmax_list) else None,
-                'tmin': tmin_list[i] if i < len(tmin_list) else None,
-                'precipitacion_mm': precip_list[i] if i < len(precip_list) else None,
-                'viento_kmh': viento_list[i] if i < len(viento_list) else None,
-                'nubosidad_perc': 50,  # Dato simulado
-                'condiciones': map_wmo_code(code_list[i] if i < len(code_list) else None)
-            }
-            datos_procesados.append(datos_dia)
-        return datos_procesados
-
-    except requests.exceptions.HTTPError as e:
+
+def _error_descarga(e):
+    """Traduce una excepción de descarga al dict de error que muestran las vistas."""
+    if isinstance(e, (CircuitoAbierto, TimeoutError)):
+        return {"error": str(e)}
+    if isinstance(e, requests.exceptions.HTTPError):
         return {
-            "error": f"Error API HTTP: {e.response.status_code}. Mensaje: {response.text}. Revisa la URL de la API."}
-    except requests.exceptions.RequestException as e:
+            "error": f"Error API HTTP: {e.response.status_code}. Mensaje: {e.response.text}. Revisa la URL de la API."}
+    if isinstance(e, requests.exceptions.RequestException):
         return {"error": f"Error de conexión a la API: {e}. Revisa tu conexión a internet."}
+    return {"error": f"Error inesperado procesando datos: {e}"}
+
+
+def obtener_historial_climatico(lat, lon, año):
+    """Obtiene el historial climático (SerieClimatica) desde el 1 de enero del año especificado
+    hasta 5 días antes de hoy, sirviendo desde la caché local lo ya descargado."""
+
+    rango = rango_fechas_año(año)
+    if isinstance(rango, dict):
+        return rango
+    fecha_inicio, fecha_fin = rango
+
+    try:
+        daily_data = obtener_diario_cacheado(*coordenada_archivo(lat, lon), fecha_inicio, fecha_fin)
+        return SerieClimatica.desde_diario(daily_data)
     except Exception as e:
-        return {"error": f"Error inesperado procesando datos: {e}"}
+        return _error_descarga(e)
+
+
+def obtener_historial_lote(coordenadas, año, tamaño_lote=None):
+    """Obtiene el historial de varias coordenadas agrupando las descargas en llamadas multi-coordenada.
+
+    Devuelve una lista con el resultado de cada coordenada en el mismo orden (SerieClimatica
+    o dict de error). Las coordenadas completas en caché no generan ninguna llamada y las de
+    una misma celda del archivo comparten una sola descarga y un solo resultado."""
+    rango = rango_fechas_año(año)
+    if isinstance(rango, dict):
+        return [rango for _ in coordenadas]
+    fecha_inicio, fecha_fin = rango
+    tamaño_lote = tamaño_lote or ARCHIVO_TAMAÑO_LOTE
+    celdas_pedidas = [coordenada_archivo(lat, lon) for lat, lon in coordenadas]
+    coordenadas = list(dict.fromkeys(celdas_pedidas))
+
+    diarios = [None] * len(coordenadas)
+    resultados = [None] * len(coordenadas)
+    pendientes_por_desde = {}
+    en_otro_hilo = []
+    tomadas = set()  # claves de las que este hilo es líder y que aún no liberó
+    try:
+        for i, (lat, lon) in enumerate(coordenadas):
+            try:
+                almacenado, desde = _pendiente_cache(lat, lon, fecha_inicio, fecha_fin)
+            except Exception as e:
+                resultados[i] = _error_descarga(e)
+                continue
+            _contar_cache_archivo(almacenado, desde)
+            diarios[i] = almacenado
+            if desde is None:
+                continue
+            clave = clave_vuelo(lat, lon, desde, fecha_fin)
+            estado = iniciar_vuelo(clave, esperar=False)
+            if estado == 'lider':
+                tomadas.add(clave)
+                # Normalmente todas las coordenadas comparten la misma fecha de corte y van juntas
+                pendientes_por_desde.setdefault(desde, []).append(i)
+            else:
+                # 'en_curso' se espera más abajo; 'hecho' se relee de la caché sin esperar
+                en_otro_hilo.append((i, desde))
+
+        for desde, indices in pendientes_por_desde.items():
+            for inicio_lote in range(0, len(indices), tamaño_lote):
+                lote = indices[inicio_lote:inicio_lote + tamaño_lote]
+                try:
+                    nuevos_lote = descargar_diario_lote([coordenadas[i] for i in lote], desde, fecha_fin)
+                except Exception as e:
+                    for i in lote:
+                        clave = clave_vuelo(*coordenadas[i], desde, fecha_fin)
+                        tomadas.discard(clave)
+                        terminar_vuelo(clave, False)
+                        if diarios[i]['time']:
+                            logger.warning("No se pudo actualizar la caché para %s desde %s: %s",
+                                           coordenadas[i], desde, e)
+                        else:
+                            resultados[i] = _error_descarga(e)
+                    continue
+                for i, nuevos in zip(lote, nuevos_lote):
+                    lat, lon = coordenadas[i]
+                    clave = clave_vuelo(lat, lon, desde, fecha_fin)
+                    exito, revisadas = False, ()
+                    try:
+                        guardar_cache_diaria(lat, lon, nuevos)
+                        exito = True
+                        revisadas = _revisiones_pendientes(lat, lon, nuevos, fecha_fin)
+                    except Exception as e:
+                        # Lo descargado sirve igual para esta respuesta aunque no quede en la caché
+                        logger.warning("No se pudo guardar en caché %s desde %s: %s", coordenadas[i], desde, e)
+                    finally:
+                        tomadas.discard(clave)
+                        terminar_vuelo(clave, exito, revisadas)
+                    diarios[i] = _unir_diarios(diarios[i], nuevos)
+
+        # Las coordenadas que descargaba otro hilo o worker se leen de la caché cuando termina
+        for i, desde in en_otro_hilo:
+            try:
+                esperar_vuelo(clave_vuelo(*coordenadas[i], desde, fecha_fin))
+                diarios[i] = leer_cache_diaria(*coordenadas[i], fecha_inicio, fecha_fin)
+            except Exception as e:
+                resultados[i] = _error_descarga(e)
+                continue
+            if not diarios[i]['time']:
+                resultados[i] = {"error": DESCARGA_AJENA_SIN_DATOS}
+
+        for i, diario in enumerate(diarios):
+            if resultados[i] is None:
+                try:
+                    resultados[i] = SerieClimatica.desde_diario(diario)
+                except Exception as e:
+                    resultados[i] = _error_descarga(e)
+    finally:
+        # Ante cualquier error a mitad de camino, las descargas tomadas no quedan bloqueadas
+        for clave in tomadas:
+            terminar_vuelo(clave, False)
+    por_celda = dict(zip(coordenadas, resultados))
+    return [por_celda[celda] for celda in celdas_pedidas]
+
+
+# -------------------------------------------------------------------------
+# Caché de resultados consultados (handles para exportar)
+# -------------------------------------------------------------------------
+# La página de historial guarda la serie ya filtrada bajo el hash de la consulta y las
+# exportaciones solo envían ese identificador. Vive en la misma base SQLite, por lo que
+# cualquier worker de gunicorn puede atender la exportación. Es un LRU acotado con TTL contado
+# desde el último acceso, para que un handle recién mostrado siga sirviendo para exportar.
+RESULTADOS_MAX_ENTRADAS = int(os.getenv('RESULTADOS_MAX_ENTRADAS', '500'))
+RESULTADOS_TTL = float(os.getenv('RESULTADOS_TTL', '3600'))
+
+
+def clave_consulta(tienda, filtros):
+    """Hash estable de una consulta de historial (tienda, año y filtros)."""
+    contenido = json.dumps({'tienda': tienda, 'filtros': filtros}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(contenido.encode('utf-8')).hexdigest()[:32]
+
+
+def año_cerrado(año, serie):
+    """Indica si la serie (sin filtrar) cubre un año ya cerrado: pasado el retraso del archivo y con
+    datos hasta el 31 de diciembre (no una caché parcial que quedó así por un error del archivo)."""
+    return (int(año) < año_con_datos() and len(serie) > 0
+            and serie.fechas[-1] >= np.datetime64(f"{int(año)}-12-31"))
+
+
+def guardar_resultado(clave, tienda, año, serie, cerrado=False):
+    """Guarda la serie filtrada de una consulta y recorta la caché por TTL y por tamaño.
+
+    'cerrado' indica que sale de un año cerrado completo (año_cerrado) y puede reutilizarse tal cual."""
+    ahora = time.time()
+    conexion = _conexion_cache()
+    with conexion:
+        conexion.execute("INSERT OR REPLACE INTO resultados (clave, creado, accedido, tienda, año, datos, cerrado) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (clave, ahora, ahora, tienda, str(año), serie.a_bytes(), int(cerrado)))
+        conexion.execute("DELETE FROM resultados WHERE accedido < ?", (ahora - RESULTADOS_TTL,))
+        conexion.execute("DELETE FROM resultados WHERE clave IN (SELECT clave FROM resultados "
+                         "ORDER BY accedido DESC LIMIT -1 OFFSET ?)", (RESULTADOS_MAX_ENTRADAS,))
+
+
+def leer_resultado(clave, solo_cerrados=False):
+    """Devuelve (tienda, año, serie) de una consulta guardada y vigente, o None.
+
+    Con solo_cerrados=True solo sirve resultados de años cerrados: los demás pueden haber quedado
+    incompletos y deben recalcularse aunque se sigan leyendo (el TTL se renueva con cada lectura)."""
+    if not clave:
+        return None
+    ahora = time.time()
+    conexion = _conexion_cache()
+    fila = conexion.execute("SELECT tienda, año, datos FROM resultados WHERE clave = ? AND accedido >= ? "
+                            "AND cerrado >= ?", (clave, ahora - RESULTADOS_TTL, int(solo_cerrados))).fetchone()
+    METRICAS.contar('clima_cache_total', cache='resultados', resultado='fallo' if fila is None else 'acierto')
+    if fila is None:
+        return None
+    with conexion:
+        conexion.execute("UPDATE resultados SET accedido = ? WHERE clave = ?", (ahora, clave))
+    return fila[0], fila[1], SerieClimatica.desde_bytes(fila[2])
+
+
+# -------------------------------------------------------------------------
+# Motor de filtros vectorizado
+# -------------------------------------------------------------------------
+# Campo del formulario -> (atributo de SerieClimatica, etiqueta para mensajes de error)
+CAMPOS_RANGO_FILTRO = {
+    'tmax': ('tmax', 'T° Máx (°C)'),
+    'tmin': ('tmin', 'T° Mín (°C)'),
+    'precip': ('precipitacion', 'Lluvia (mm)'),
+    'viento': ('viento', 'Viento (km/h)'),
+}
+OPCIONES_NULOS = {'excluir', 'incluir'}
 
 
-def aplicar_filtros(datos, filtros):
-    if not datos or "error" in datos: return datos
-    datos_filtrados = []
-    tmax_min_val = float(filtros.get('tmax_min')) if filtros.get('tmax_min') else None
-    precip_min_val = float(filtros.get('precip_min')) if filtros.get('precip_min') else None
-    viento_min_val = float(filtros.get('viento_min')) if filtros.get('viento_min') else None
-    condiciones_filtro_val = filtros.get('condiciones_filtro')
+def filtros_por_defecto(año_actual):
+    """Filtros vacíos del formulario (sin rangos, todas las condiciones y días)."""
+    filtros = {f"{campo}_{limite}": '' for campo in CAMPOS_RANGO_FILTRO for limite in ('min', 'max')}
+    filtros.update({'condiciones_filtro': [], 'dias_semana': [], 'nulos': 'excluir', 'año_filtro': str(año_actual)})
+    return filtros
 
-    for dia in datos:
-        incluir = True
-        tmax = dia.get('tmax', -100)
-        precip = dia.get('precipitacion_mm', 0)
-        viento = dia.get('viento_kmh', 0)
-        condicion_actual = dia.get('condiciones')
 
-        if condiciones_filtro_val and condiciones_filtro_val != "TODAS":
-            if condicion_actual != condiciones_filtro_val: incluir = False
-        if incluir and tmax_min_val is not None and tmax < tmax_min_val: incluir = False
-        if incluir and precip_min_val is not None and precip < precip_min_val: incluir = False
-        if incluir and viento_min_val is not None and viento < viento_min_val: incluir = False
+def leer_filtros_formulario(form, año_actual):
+    """Lee los filtros de un formulario o query string (MultiDict) con las mismas claves que filtros_por_defecto."""
+    filtros = filtros_por_defecto(año_actual)
+    for clave in filtros:
+        if clave in ('condiciones_filtro', 'dias_semana'):
+            # 'TODAS' equivale a no filtrar por condición (compatibilidad con el selector anterior)
+            filtros[clave] = [v for v in form.getlist(clave) if v and v != 'TODAS']
+        else:
+            filtros[clave] = form.get(clave, filtros[clave]).strip()
+    return filtros
+
+
+class FiltroClimatico:
+    """Filtro compilado a partir del formulario: se evalúa como una sola máscara sobre las columnas.
+
+    Los rangos son inclusivos. Un día sin dato en una variable con rango no lo cumple
+    (nulos='excluir') o lo cumple (nulos='incluir'); nunca se sustituye por un valor ficticio."""
+
+    def __init__(self, rangos, condiciones, dias_semana, incluir_nulos):
+        self.rangos = rangos  # [(atributo, minimo | None, maximo | None)]
+        self.condiciones = condiciones  # índices en CONDICIONES, o None para todas
+        self.dias_semana = dias_semana  # 0 = lunes, o None para todos
+        self.incluir_nulos = incluir_nulos
+
+    def mascara(self, serie):
+        mascara = np.ones(len(serie), dtype=bool)
+        for atributo, minimo, maximo in self.rangos:
+            columna = getattr(serie, atributo)
+            cumple = np.ones(len(serie), dtype=bool)
+            # Las comparaciones con NaN son falsas, por lo que los nulos quedan fuera salvo que se incluyan
+            if minimo is not None: cumple &= columna >= minimo
+            if maximo is not None: cumple &= columna <= maximo
+            if self.incluir_nulos: cumple |= np.isnan(columna)
+            mascara &= cumple
+        if self.condiciones is not None:
+            mascara &= np.isin(serie.indice_condicion, self.condiciones)
+        if self.dias_semana is not None:
+            mascara &= np.isin(serie.dia_semana, self.dias_semana)
+        return mascara
+
+    def aplicar(self, serie):
+        return serie.seleccionar(self.mascara(serie))
+
+
+def _leer_numero_filtro(valor, etiqueta):
+    try:
+        numero = float(valor.replace(',', '.'))
+    except ValueError:
+        raise ValueError(f"Valor no válido en el filtro {etiqueta}: '{valor}'.")
+    if not np.isfinite(numero):
+        raise ValueError(f"Valor no válido en el filtro {etiqueta}: '{valor}'.")
+    return numero
 
-        if incluir: datos_filtrados.append(dia)
-    return datos_filtrados
 
+def compilar_filtros(filtros):
+    """Valida los filtros del formulario y los compila en un FiltroClimatico, o devuelve un dict de error."""
+    try:
+        rangos = []
+        for campo, (atributo, etiqueta) in CAMPOS_RANGO_FILTRO.items():
+            minimo = filtros.get(f"{campo}_min") or None
+            maximo = filtros.get(f"{campo}_max") or None
+            minimo = _leer_numero_filtro(minimo, f"{etiqueta}, mínimo") if minimo is not None else None
+            maximo = _leer_numero_filtro(maximo, f"{etiqueta}, máximo") if maximo is not None else None
+            if minimo is not None and maximo is not None and minimo > maximo:
+                raise ValueError(f"En el filtro {etiqueta} el mínimo ({minimo:g}) supera al máximo ({maximo:g}).")
+            if minimo is not None or maximo is not None:
+                rangos.append((atributo, minimo, maximo))
+
+        condiciones = None
+        nombres_condicion = filtros.get('condiciones_filtro') or []
+        if isinstance(nombres_condicion, str):
+            nombres_condicion = [nombres_condicion]
+        nombres_condicion = [c for c in nombres_condicion if c and c != 'TODAS']
+        if nombres_condicion:
+            desconocidas = [c for c in nombres_condicion if c not in CONDICIONES]
+            if desconocidas:
+                raise ValueError(f"Condición no reconocida: {', '.join(desconocidas)}.")
+            condiciones = [CONDICIONES.index(c) for c in nombres_condicion]
+
+        dias_semana = None
+        if filtros.get('dias_semana'):
+            try:
+                dias_semana = sorted({int(d) for d in filtros['dias_semana']})
+            except ValueError:
+                raise ValueError("Día de la semana no válido en el filtro.")
+            if any(d not in DIAS_SEMANA_ES for d in dias_semana):
+                raise ValueError("Día de la semana no válido en el filtro.")
+
+        nulos = filtros.get('nulos') or 'excluir'
+        if nulos not in OPCIONES_NULOS:
+            raise ValueError(f"Opción de nulos no válida: '{nulos}'.")
+    except ValueError as e:
+        return {"error": str(e)}
+    return FiltroClimatico(rangos, condiciones, dias_semana, nulos == 'incluir')
+
+
+@medido('filtros')
+def aplicar_filtros(serie, filtros):
+    """Filtra la serie (de una o varias tiendas/años) en una sola pasada vectorizada.
+
+    Devuelve una nueva SerieClimatica, o un dict de error si la serie o los filtros no son válidos."""
+    if isinstance(serie, dict): return serie
+    filtro = compilar_filtros(filtros)
+    if isinstance(filtro, dict): return filtro
+    return filtro.aplicar(serie)
+
+
+def _entrada_ranking(nombre, lat, lon, datos_crudos):
+    """Construye la fila del ranking de una tienda a partir de su historial (o de su error)."""
+    entrada = {'tienda': nombre, 'tmax_promedio': None, 'lat': lat, 'lon': lon, 'tipo': nombre.split()[0]}
+    if isinstance(datos_crudos, dict) and "error" in datos_crudos:
+        logger.error("Error al obtener datos para %s: %s", nombre, datos_crudos['error'])
+        entrada['error'] = datos_crudos['error']
+        return entrada
+    tmax_validos = datos_crudos.tmax[~np.isnan(datos_crudos.tmax)]
+    if len(tmax_validos):
+        entrada['tmax_promedio'] = round(float(tmax_validos.mean()), 2)
+    return entrada
+
+
+def resultados_lote(futuro, n_coordenadas):
+    """Resultados de un lote terminado del pool; si el lote falló, un dict de error por coordenada."""
+    try:
+        return futuro.result()
+    except Exception as e:
+        logger.exception("Falló un lote de %d coordenadas", n_coordenadas)
+        return [_error_descarga(e)] * n_coordenadas
+
+
+@medido('ranking')
+def calcular_ranking_anual(tiendas_map, año=None, plazo_segundos=None):
+    """Calcula el ranking del año descargando las celdas del archivo por lotes multi-coordenada en paralelo.
+
+    Cada lote de ARCHIVO_TAMAÑO_LOTE celdas es una sola llamada al archivo y los lotes se
+    reparten en el pool compartido; la serie de cada celda se reparte a todas sus tiendas.
+    Las tiendas cuyo lote no responde antes del plazo global quedan sin promedio y el
+    resultado se marca como parcial, en lugar de bloquear la página."""
+    año_base = int(año) if año is not None else año_con_datos()
+    rango = rango_fechas_año(año_base)
+    if isinstance(rango, dict):
+        return {'ranking': [], 'año': año_base, 'fecha_inicio': None, 'fecha_fin': None,
+                'parcial': False, 'tiendas_pendientes': 0, 'error': rango['error']}
+    fecha_inicio, fecha_fin = rango
+    plazo = RANKING_PLAZO_SEGUNDOS if plazo_segundos is None else plazo_segundos
+
+    por_celda = agrupar_por_celda(tiendas_map)
+    celdas = list(por_celda)
+    lotes = [celdas[i:i + ARCHIVO_TAMAÑO_LOTE] for i in range(0, len(celdas), ARCHIVO_TAMAÑO_LOTE)]
+    futuros = {POOL_DESCARGAS.submit(obtener_historial_lote, lote, año_base): lote for lote in lotes}
+    terminados, pendientes = wait(futuros, timeout=plazo)
+    for futuro in pendientes:
+        # Los lotes que aún no empezaron se cancelan; los que están en curso terminan en segundo plano
+        futuro.cancel()
 
-def calcular_ranking_anual(tiendas_map):
     ranking = []
-    fecha_inicio = "2024-01-01"
-    hoy = datetime.now()
-    fecha_fin = (hoy - timedelta(days=5)).strftime('%Y-%m-%d')
-    año_base = 2024
-
-    for nombre, (lat, lon) in tiendas_map.items():
-        datos_crudos = obtener_historial_climatico(lat, lon, año_base)
-        if isinstance(datos_crudos, dict) and "error" in datos_crudos:
-            print(f"Error al obtener datos para {nombre}: {datos_crudos['error']}")
-            ranking.append({'tienda': nombre, 'tmax_promedio': None, 'lat': lat, 'lon': lon, 'tipo': nombre.split()[0]})
-            continue
-        if datos_crudos:
-            tmax_validos = [dia['tmax'] for dia in datos_crudos if dia.get('tmax') is not None]
-            avg_tmax = sum(tmax_validos) / len(tmax_validos) if tmax_validos else None
-            ranking.append(
-                {'tienda': nombre, 'tmax_promedio': round(avg_tmax, 2) if avg_tmax is not None else None, 'lat': lat,
-                 'lon': lon, 'tipo': nombre.split()[0]})
+    for futuro, lote in futuros.items():
+        if futuro in terminados:
+            resultados = resultados_lote(futuro, len(lote))
         else:
-            ranking.append({'tienda': nombre, 'tmax_promedio': None, 'lat': lat, 'lon': lon, 'tipo': nombre.split()[0]})
+            resultados = [{"error": f"Sin respuesta dentro del plazo de {plazo:g} s."}] * len(lote)
+        for celda, datos_crudos in zip(lote, resultados):
+            for nombre in por_celda[celda]:
+                ranking.append(_entrada_ranking(nombre, *tiendas_map[nombre], datos_crudos))
 
     ranking.sort(key=lambda x: x['tmax_promedio'] if x['tmax_promedio'] is not None else -float('inf'), reverse=True)
-    return {'ranking': ranking, 'fecha_inicio': fecha_inicio, 'fecha_fin': fecha_fin}
+    # Pendientes son las tiendas sin datos, ya sea por el plazo o por un error de descarga
+    tiendas_pendientes = sum(1 for entrada in ranking if 'error' in entrada)
+    return {'ranking': ranking, 'año': año_base, 'fecha_inicio': fecha_inicio, 'fecha_fin': fecha_fin,
+            'parcial': tiendas_pendientes > 0, 'tiendas_pendientes': tiendas_pendientes}
+
+
+# -------------------------------------------------------------------------
+# Snapshots precalculados del ranking
+# -------------------------------------------------------------------------
+# La vista /ranking sirve el último snapshot guardado del año pedido. Los snapshots se
+# generan con `flask --app app refrescar-ranking` (cron) o con el hilo de refresco
+# (RANKING_REFRESCO_SEGUNDOS > 0); el del año en curso se renueva en segundo plano al vencer.
+_refrescos_en_curso = set()
+_refrescos_lock = threading.Lock()
+
+
+def leer_snapshot_ranking(año):
+    """Devuelve el último snapshot del ranking del año (con 'generado_en'), o None si no existe."""
+    fila = _conexion_cache().execute(
+        "SELECT generado_en, datos FROM ranking_snapshots WHERE año = ?", (int(año),)).fetchone()
+    if fila is None:
+        return None
+    ranking_data = json.loads(fila[1])
+    ranking_data['generado_en'] = fila[0]
+    return ranking_data
+
+
+def guardar_snapshot_ranking(ranking_data):
+    """Guarda el ranking como snapshot de su año y devuelve la marca de tiempo asignada."""
+    generado_en = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    datos = {k: v for k, v in ranking_data.items() if k != 'generado_en'}
+    conexion = _conexion_cache()
+    with conexion:
+        conexion.execute("INSERT OR REPLACE INTO ranking_snapshots (año, generado_en, datos) VALUES (?, ?, ?)",
+                         (ranking_data['año'], generado_en, json.dumps(datos)))
+    return generado_en
+
+
+def refrescar_ranking(año):
+    """Recalcula el ranking del año y lo guarda como snapshot.
+
+    Un resultado parcial (o con error) no reemplaza a un snapshot completo ya existente, y uno
+    en el que fallaron todas las tiendas no se guarda: se devuelve el anterior, si lo hay."""
+    ranking_data = calcular_ranking_anual(TIENDAS_MAP, año)
+    if ranking_data.get('error'):
+        return ranking_data
+    anterior = leer_snapshot_ranking(ranking_data['año'])
+    if ranking_data['parcial'] and anterior is not None and not snapshot_con_errores(anterior):
+        return anterior
+    if ranking_data['tiendas_pendientes'] == len(ranking_data['ranking']):
+        return anterior or ranking_data
+    ranking_data['generado_en'] = guardar_snapshot_ranking(ranking_data)
+    return ranking_data
+
+
+def snapshot_con_errores(ranking_data):
+    """Indica si al snapshot le faltan tiendas (parcial o con filas de error, como los guardados antes de contarlas)."""
+    return bool(ranking_data.get('parcial')) or any('error' in entrada for entrada in ranking_data['ranking'])
+
+
+def snapshot_vencido(ranking_data):
+    """Indica si el snapshot debe regenerarse: parcial, o no cerrado y más viejo que el TTL.
+
+    El de un año pasado queda cerrado cuando llega al 31 de diciembre y se generó con esos días
+    ya publicados (el archivo va 5 días atrasado); uno generado durante diciembre no lo está."""
+    if snapshot_con_errores(ranking_data):
+        return True
+    año = ranking_data['año']
+    generado_en = datetime.strptime(ranking_data['generado_en'], '%Y-%m-%d %H:%M:%S')
+    cerrado = (año < datetime.now().year and (ranking_data.get('fecha_fin') or '') >= f"{año}-12-31"
+               and generado_en >= datetime(año + 1, 1, 1) + timedelta(days=RETRASO_ARCHIVO_DIAS))
+    if cerrado:
+        return False
+    return (datetime.now() - generado_en).total_seconds() > RANKING_SNAPSHOT_TTL
+
+
+def refrescar_ranking_en_segundo_plano(año):
+    """Lanza el refresco del año en un hilo aparte, salvo que ya haya uno en curso en este proceso."""
+    with _refrescos_lock:
+        if año in _refrescos_en_curso:
+            return
+        _refrescos_en_curso.add(año)
+
+    def _tarea():
+        try:
+            refrescar_ranking(año)
+        except Exception:
+            logger.exception("Error refrescando el ranking de %s", año)
+        finally:
+            with _refrescos_lock:
+                _refrescos_en_curso.discard(año)
+
+    threading.Thread(target=_tarea, name=f'refresco_ranking_{año}', daemon=True).start()
+
+
+def obtener_ranking(año):
+    """Ranking del año para la vista: snapshot guardado si existe, calculándolo solo la primera vez."""
+    ranking_data = leer_snapshot_ranking(año)
+    METRICAS.contar('clima_cache_total', cache='ranking', resultado='fallo' if ranking_data is None else 'acierto')
+    if ranking_data is None:
+        return refrescar_ranking(año)
+    if snapshot_vencido(ranking_data):
+        # Se sirve el snapshot actual y se renueva sin bloquear la petición
+        refrescar_ranking_en_segundo_plano(ranking_data['año'])
+    return ranking_data
+
+
+def iniciar_refresco_periodico(intervalo=RANKING_REFRESCO_SEGUNDOS):
+    """Inicia el hilo que mantiene al día el snapshot del año en curso (y cierra el del año anterior)."""
+
+    def _ciclo():
+        while True:
+            # Del 1 al 5 de enero el año en curso aún no tiene días y solo se cierra el anterior
+            for año in sorted({datetime.now().year - 1, año_con_datos()}):
+                snapshot = leer_snapshot_ranking(año)
+                if snapshot is None or snapshot_vencido(snapshot):
+                    try:
+                        refrescar_ranking(año)
+                    except Exception:
+                        logger.exception("Error refrescando el ranking de %s", año)
+            time.sleep(intervalo)
+
+    threading.Thread(target=_ciclo, name='refresco_ranking_periodico', daemon=True).start()
+
+
+# -------------------------------------------------------------------------
+# Agregados por periodo (mes, semana ISO, día de la semana)
+# -------------------------------------------------------------------------
+# Las estadísticas se calculan por tienda sobre una matriz (grupos x días) construida con
+# índices, de modo que media, mínimo, máximo y percentiles de todos los grupos salen de una
+# sola llamada de NumPy por variable en lugar de recorrer los días en Python.
+UMBRAL_DIA_LLUVIOSO_MM = 1.0
+VARIABLES_AGREGADO = ['tmax', 'tmin', 'precipitacion', 'viento']
+PERCENTILES_AGREGADO = [10, 50, 90]
+
+
+def _grupos_mes(fechas):
+    meses = fechas.astype('datetime64[M]')
+    unicos, codigos = np.unique(meses, return_inverse=True)
+    return codigos, np.datetime_as_string(unicos, unit='M').tolist()
+
+
+def _grupos_semana_iso(fechas):
+    dias = fechas.astype('int64')
+    # La semana ISO es la del jueves: lunes de la semana (día de la época - día de la semana) + 3
+    jueves = dias - (dias + 3) % 7 + 3
+    año_iso = jueves.astype('datetime64[D]').astype('datetime64[Y]')
+    semana = (jueves - año_iso.astype('datetime64[D]').astype('int64')) // 7 + 1
+    unicos, codigos = np.unique((año_iso.astype('int64') + 1970) * 100 + semana, return_inverse=True)
+    return codigos, [f"{clave // 100}-W{clave % 100:02d}" for clave in unicos.tolist()]
+
+
+def _grupos_dia_semana(fechas):
+    unicos, codigos = np.unique((fechas.astype('int64') + 3) % 7, return_inverse=True)
+    return codigos, [DIAS_SEMANA_ES[dia] for dia in unicos.tolist()]
+
+
+def _grupos_total(fechas):
+    etiqueta = f"{np.datetime_as_string(fechas.min(), unit='D')}/{np.datetime_as_string(fechas.max(), unit='D')}"
+    return np.zeros(len(fechas), dtype=np.int64), [etiqueta]
+
+
+PERIODOS_AGREGADO = {'mes': _grupos_mes, 'semana': _grupos_semana_iso, 'dia_semana': _grupos_dia_semana,
+                     'total': _grupos_total}
+
+
+def leer_percentiles(texto):
+    """Interpreta '10,50,90' como lista de percentiles; devuelve la lista o un dict de error."""
+    if not texto:
+        return list(PERCENTILES_AGREGADO)
+    try:
+        percentiles = sorted({int(p) for p in texto.split(',') if p.strip()})
+    except ValueError:
+        return {"error": f"Percentiles no válidos: '{texto}'."}
+    if not percentiles or any(p < 0 or p > 100 for p in percentiles):
+        return {"error": "Los percentiles deben estar entre 0 y 100."}
+    return percentiles
+
+
+def _matriz_grupos(codigos, n_grupos):
+    """Índices de los días de cada grupo como matriz (grupos x máx. días por grupo), con -1 de relleno."""
+    orden = np.argsort(codigos, kind='stable')
+    conteos = np.bincount(codigos, minlength=n_grupos)
+    inicios = np.cumsum(conteos) - conteos
+    posicion = np.arange(len(codigos)) - np.repeat(inicios, conteos)
+    matriz = np.full((n_grupos, conteos.max(initial=0)), -1, dtype=np.int64)
+    matriz[codigos[orden], posicion] = orden
+    return matriz, conteos
+
+
+def _lista_json(valores, decimales=2):
+    """Array -> lista de floats redondeados, con None en lugar de NaN."""
+    valores = np.round(valores, decimales)
+    return np.where(np.isnan(valores), None, valores).tolist()
+
+
+def _estadisticas_grupos(columna, matriz, percentiles):
+    """Media, mínimo, máximo y percentiles (interpolación lineal, como np.percentile) por fila de la matriz.
+
+    Cada fila se ordena una sola vez (los NaN quedan al final) y los percentiles se leen por
+    posición; np.nanpercentile con NaN recorre las filas una a una y es mucho más lento."""
+    ordenados = np.sort(np.where(matriz >= 0, columna[matriz], np.nan), axis=1)
+    validos = np.sum(~np.isnan(ordenados), axis=1)
+    ultimo = np.maximum(validos - 1, 0)[:, None]
+    sin_datos = validos == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        estadisticas = {
+            'media': np.nansum(ordenados, axis=1) / validos,
+            'min': np.where(sin_datos, np.nan, ordenados[:, 0]),
+            'max': np.where(sin_datos, np.nan, np.take_along_axis(ordenados, ultimo, axis=1)[:, 0]),
+        }
+    for p in percentiles:
+        posicion = ultimo[:, 0] * (p / 100)
+        bajo = np.floor(posicion).astype(np.int64)
+        alto = np.ceil(posicion).astype(np.int64)
+        valor_bajo = np.take_along_axis(ordenados, bajo[:, None], axis=1)[:, 0]
+        valor_alto = np.take_along_axis(ordenados, alto[:, None], axis=1)[:, 0]
+        estadisticas[f'p{p}'] = np.where(sin_datos, np.nan, valor_bajo + (valor_alto - valor_bajo) * (posicion - bajo))
+    resultado = {clave: _lista_json(valores) for clave, valores in estadisticas.items()}
+    resultado['dias_con_dato'] = validos.tolist()
+    return resultado
+
+
+def agregar_serie(serie, periodo, percentiles=PERCENTILES_AGREGADO):
+    """Agregados de la serie por periodo, en columnas: cada estadística es una lista alineada con 'periodos'.
+
+    Incluye, por variable, media, mínimo, máximo y percentiles, y por periodo los días con
+    dato y los días con lluvia (>= UMBRAL_DIA_LLUVIOSO_MM)."""
+    if not len(serie):
+        return {'periodos': [], 'dias': [], 'dias_lluvia': [],
+                **{variable: {} for variable in VARIABLES_AGREGADO}}
+    codigos, etiquetas = PERIODOS_AGREGADO[periodo](serie.fechas)
+    matriz, conteos = _matriz_grupos(codigos, len(etiquetas))
+    lluviosos = serie.precipitacion >= UMBRAL_DIA_LLUVIOSO_MM
+    agregado = {
+        'periodos': etiquetas,
+        'dias': conteos.tolist(),
+        'dias_lluvia': np.bincount(codigos, weights=lluviosos, minlength=len(etiquetas)).astype(int).tolist(),
+    }
+    for variable in VARIABLES_AGREGADO:
+        agregado[variable] = _estadisticas_grupos(getattr(serie, variable), matriz, percentiles)
+    return agregado
+
+
+@medido('agregados')
+def agregados_tiendas(nombres, años, periodo, percentiles=PERCENTILES_AGREGADO):
+    """Agregados por periodo de varias tiendas (en el orden pedido), más el total del rango de cada una.
+
+    Las series salen de la caché del archivo; lo que falte se descarga por lotes multi-coordenada."""
+    series = dict(historial_tiendas_a_medida(nombres, años))
+    tiendas = []
+    for nombre in nombres:
+        lat, lon = TIENDAS_MAP[nombre]
+        entrada = {'tienda': nombre, 'tipo': nombre.split()[0], 'lat': lat, 'lon': lon}
+        serie = series[nombre]
+        if isinstance(serie, dict):
+            entrada['error'] = serie['error']
+        else:
+            entrada['agregados'] = agregar_serie(serie, periodo, percentiles)
+            entrada['total'] = agregar_serie(serie, 'total', percentiles)
+        tiendas.append(entrada)
+    return {'periodo': periodo, 'año_desde': años[0], 'año_hasta': años[-1], 'percentiles': percentiles,
+            'umbral_lluvia_mm': UMBRAL_DIA_LLUVIOSO_MM, 'tiendas': tiendas}
 
 
 # =========================================================================
 # 3. RUTAS FLASK (CON FILTRO DE AÑO)
 # =========================================================================
 
+# -------------------------------------------------------------------------
+# Medición de peticiones, /metrics y perfilado bajo demanda
+# -------------------------------------------------------------------------
+# Con PERFILADO_PETICIONES=1, una petición con ?perfil=1 (o la cabecera X-Perfil: 1) se
+# ejecuta bajo cProfile: la respuesta trae Server-Timing con las etapas medidas y el perfil
+# queda en PERFILES_DIR (se abre con pstats o snakeviz). Solo cubre el hilo de la petición,
+# no las descargas del pool ni el envío de las respuestas en streaming.
+PERFILADO_PETICIONES = os.getenv('PERFILADO_PETICIONES', '0') == '1'
+PERFILES_DIR = os.getenv('PERFILES_DIR', os.path.join(app.instance_path, 'perfiles'))
+_perfilado_lock = threading.Lock()  # cProfile no admite dos perfiles activos a la vez
+
+
+def guardar_perfil(perfil, ruta):
+    """Guarda el perfil en PERFILES_DIR, registra las funciones más costosas y devuelve el nombre del archivo."""
+    os.makedirs(PERFILES_DIR, exist_ok=True)
+    sufijo = ''.join(c if c.isalnum() else '_' for c in ruta).strip('_') or 'raiz'
+    nombre = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}_{sufijo}.prof"
+    perfil.dump_stats(os.path.join(PERFILES_DIR, nombre))
+    resumen = StringIO()
+    pstats.Stats(perfil, stream=resumen).sort_stats('cumulative').print_stats(15)
+    logger.info("Perfil de %s %s guardado en %s\n%s", request.method, request.path, nombre, resumen.getvalue())
+    return nombre
+
+
+@app.before_request
+def iniciar_medicion():
+    g.inicio_peticion = time.perf_counter()
+    g.etapas = {}
+    pedido = request.args.get('perfil') or request.headers.get('X-Perfil')
+    if PERFILADO_PETICIONES and pedido and _perfilado_lock.acquire(blocking=False):
+        g.perfil = cProfile.Profile()
+        g.perfil.enable()
+
+
+@app.after_request
+def registrar_peticion(response):
+    duracion = time.perf_counter() - g.inicio_peticion
+    ruta = request.url_rule.rule if request.url_rule else 'sin_ruta'
+    METRICAS.contar('clima_http_peticiones_total', ruta=ruta, metodo=request.method, estado=response.status_code)
+    METRICAS.observar('clima_http_segundos', duracion, ruta=ruta)
+    perfil = g.pop('perfil', None)
+    if perfil is not None:
+        perfil.disable()
+        _perfilado_lock.release()
+        tiempos = [f"{etapa};dur={segundos * 1000:.1f}" for etapa, segundos in g.etapas.items()]
+        response.headers['Server-Timing'] = ', '.join([*tiempos, f"total;dur={duracion * 1000:.1f}"])
+        response.headers['X-Perfil'] = guardar_perfil(perfil, ruta)
+    volcar_metricas()
+    return response
+
+
+@app.teardown_request
+def liberar_perfil(error=None):
+    # Si la vista lanzó una excepción no pasa por after_request: el perfil se descarta aquí
+    perfil = g.pop('perfil', None)
+    if perfil is not None:
+        perfil.disable()
+        _perfilado_lock.release()
+
+
+@app.route("/metrics", methods=["GET"])
+def metricas():
+    """Métricas de todos los workers en el formato de texto de Prometheus."""
+    volcar_metricas(forzar=True)
+    return Response(exposicion_prometheus(instantaneas_procesos()),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route("/", methods=["GET", "POST"])
 def historial_detallado():
     tienda_seleccionada = None
     datos_historial = None
+    resultado_id = None
     error_message = None
 
     año_actual = datetime.now().year
     # Por defecto, establece el año de consulta en el año actual
-    filtros_aplicados = {
-        'tmax_min': '', 'precip_min': '', 'viento_min': '',
-        'condiciones_filtro': 'TODAS',
-        'año_filtro': str(año_actual)
-    }
+    filtros_aplicados = filtros_por_defecto(año_actual)
 
     if request.method == "POST":
         tienda_seleccionada = request.form.get("tienda")
-        # Aseguramos que el año_filtro se recupere correctamente del formulario
-        filtros_aplicados = {
-            'tmax_min': request.form.get("tmax_min", ""),
-            'precip_min': request.form.get("precip_min", ""),
-            'viento_min': request.form.get("viento_min", ""),
-            'condiciones_filtro': request.form.get("condiciones_filtro", "TODAS"),
-            'año_filtro': request.form.get("año_filtro", str(año_actual)),
-        }
+        filtros_aplicados = leer_filtros_formulario(request.form, año_actual)
 
         if tienda_seleccionada in TIENDAS_MAP:
             lat, lon = TIENDAS_MAP[tienda_seleccionada]
             año_consulta = filtros_aplicados['año_filtro']
 
-            # Pasar el año a la función
-            datos_crudos = obtener_historial_climatico(lat, lon, año_consulta)
-
-            if isinstance(datos_crudos, dict) and "error" in datos_crudos:
-                error_message = datos_crudos["error"]
+            resultado_id = clave_consulta(tienda_seleccionada, filtros_aplicados)
+            # Solo se reutiliza el resultado de un año cerrado; los demás (año en curso, año recién
+            # terminado o caché parcial) se recalculan desde la caché del archivo y reemplazan al anterior
+            guardado = leer_resultado(resultado_id, solo_cerrados=True)
+            if guardado is not None:
+                datos_filtrados = guardado[2]
+            else:
+                # Pasar el año a la función
+                datos_crudos = obtener_historial_climatico(lat, lon, año_consulta)
+                datos_filtrados = aplicar_filtros(datos_crudos, filtros_aplicados)
+                if not isinstance(datos_filtrados, dict):
+                    guardar_resultado(resultado_id, tienda_seleccionada, año_consulta, datos_filtrados,
+                                      cerrado=año_cerrado(año_consulta, datos_crudos))
+
+            if isinstance(datos_filtrados, dict) and "error" in datos_filtrados:
+                error_message = datos_filtrados["error"]
+                resultado_id = None
             else:
-                datos_historial = aplicar_filtros(datos_crudos, filtros_aplicados)
+                datos_historial = datos_filtrados.a_filas()
         else:
             error_message = "Tienda seleccionada no válida."
 
     if datos_historial is None and 'tienda' in request.form:
         tienda_seleccionada = request.form.get("tienda")
 
-    return render_template("index.html",
-                           tiendas_agrupadas=TIENDAS_AGRUPADAS,
-                           tienda_seleccionada=tienda_seleccionada,
-                           datos_historial=datos_historial,
-                           error_message=error_message,
-                           filtros_aplicados=filtros_aplicados,
-                           año_actual=año_actual,
-                           seccion_activa="historial")
+    with cronometrar('render'):
+        return render_template("index.html",
+                               tiendas_agrupadas=TIENDAS_AGRUPADAS,
+                               tienda_seleccionada=tienda_seleccionada,
+                               datos_historial=datos_historial,
+                               resultado_id=resultado_id,
+                               error_message=error_message,
+                               filtros_aplicados=filtros_aplicados,
+                               condiciones=CONDICIONES,
+                               dias_semana=DIAS_SEMANA_ES,
+                               año_actual=año_actual,
+                               seccion_activa="historial")
 
 
 @app.route("/ranking", methods=["GET"])
 def ranking_anual():
-    ranking_data = calcular_ranking_anual(TIENDAS_MAP)
-    return render_template("index.html",
-                           tiendas_agrupadas=TIENDAS_AGRUPADAS,
-                           ranking_data=ranking_data,
-                           seccion_activa="ranking")
+    año_actual = datetime.now().year
+    año_consulta = request.args.get("año", str(año_con_datos()))
+    try:
+        año_int = int(año_consulta)
+    except ValueError:
+        año_int = año_con_datos()
+    ranking_data = obtener_ranking(año_int)
+    with cronometrar('render'):
+        return render_template("index.html",
+                               tiendas_agrupadas=TIENDAS_AGRUPADAS,
+                               ranking_data=ranking_data,
+                               año_actual=año_actual,
+                               seccion_activa="ranking")
+
+
+@app.route("/api/agregados", methods=["GET"])
+def api_agregados():
+    """Agregados por tienda en JSON: ?periodo=mes|semana|dia_semana|total&tiendas=todas|Shopping|Templo|<lista>
+    &año_desde=AAAA&año_hasta=AAAA&percentiles=10,50,90."""
+    parametros = request.args
+    periodo = parametros.get('periodo', 'mes')
+    if periodo not in PERIODOS_AGREGADO:
+        return jsonify({"error": f"Periodo no soportado: '{periodo}'."}), 400
+    nombres = resolver_tiendas(parametros.get('tiendas'))
+    if isinstance(nombres, dict):
+        return jsonify(nombres), 400
+    años = resolver_rango_años(parametros.get('año_desde'), parametros.get('año_hasta'))
+    if isinstance(años, dict):
+        return jsonify(años), 400
+    percentiles = leer_percentiles(parametros.get('percentiles'))
+    if isinstance(percentiles, dict):
+        return jsonify(percentiles), 400
+    return jsonify(agregados_tiendas(nombres, años, periodo, percentiles))
 
 
 # =========================================================================
@@ -293,8 +1820,11 @@ def ranking_anual():
 # =========================================================================
 
 # Función de generador para CSV (stream)
-def generate_csv_rows(datos_historial):
-    """Generador que produce filas CSV a partir de datos de historial."""
+FILAS_POR_BLOQUE_CSV = 500
+
+
+def generate_csv_rows(serie):
+    """Generador que produce el CSV de la serie por bloques de filas, sin pasar por dicts."""
 
     # Define los encabezados para el CSV/Excel (sin columnas de festivos)
     headers = [
@@ -302,182 +1832,627 @@ def generate_csv_rows(datos_historial):
         'T Max (°C)', 'T Min (°C)', 'Precipitacion (mm)',
         'Viento Max (km/h)', 'Condiciones', 'Nubosidad (%)'
     ]
-
-    # 1. Yield the header row
-    output = StringIO()
-    writer = csv.writer(output)
-    writer.writerow(headers)
-    yield output.getvalue()
-
-    # 2. Yield data rows
-    for dia in datos_historial:
-        output.seek(0)
-        output.truncate(0)
-
-        row = [
-            dia.get('fecha', ''),
-            dia.get('nombre_dia', ''),
-            # 'es_festivo' y 'nombre_festivo' eliminados
-            dia.get('tmax', ''),
-            dia.get('tmin', ''),
-            dia.get('precipitacion_mm', ''),
-            dia.get('viento_kmh', ''),
-            dia.get('condiciones', ''),
-            dia.get('nubosidad_perc', '')
-        ]
-        writer.writerow(row)
-        yield output.getvalue()
+    yield _csv_texto([headers])
+    filas = filas_serie(serie)
+    while True:
+        bloque = list(islice(filas, FILAS_POR_BLOQUE_CSV))
+        if not bloque:
+            break
+        yield _csv_texto(bloque)
 
 
 # Función para generar XLSX (Excel)
-def exportar_xlsx_stream(tienda_nombre, año_consulta, datos_historial):
-    """Genera un archivo XLSX en memoria y lo devuelve como stream."""
-    buffer = BytesIO()
-    workbook = xlsxwriter.Workbook(buffer, {'in_memory': True})
-    worksheet = workbook.add_worksheet(f'Clima_{tienda_nombre}')
-
-    # Encabezados (sin columnas de festivos)
-    headers = [
-        'Fecha', 'Día',
-        'T Max (°C)', 'T Min (°C)', 'Precipitación (mm)',
-        'Viento Max (km/h)', 'Condiciones', 'Nubosidad (%)'
-    ]
+EXPORTACION_SPOOL_MAX_BYTES = int(os.getenv('EXPORTACION_SPOOL_MAX_BYTES', str(8 * 1024 * 1024)))
+TAMAÑO_BLOQUE_DESCARGA = 64 * 1024
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# Encabezados (sin columnas de festivos) y anchos precalculados: con constant_memory no se puede usar autofit()
+COLUMNAS_XLSX = [
+    ('Fecha', 12), ('Día', 11),
+    ('T Max (°C)', 11), ('T Min (°C)', 11), ('Precipitación (mm)', 19),
+    ('Viento Max (km/h)', 18), ('Condiciones', max(len(c) for c in CONDICIONES) + 2), ('Nubosidad (%)', 14),
+]
+
+
+def formatos_xlsx(workbook):
+    """Crea una vez por libro los formatos compartidos por todas las hojas."""
+    return {
+        'encabezado': workbook.add_format({'bold': True, 'bg_color': '#D9E1F2', 'border': 1}),
+        'fecha': workbook.add_format({'num_format': 'yyyy-mm-dd'}),
+        'numero': workbook.add_format({'num_format': '0.0'}),
+    }
 
-    # Formato de encabezado
-    header_format = workbook.add_format({'bold': True, 'bg_color': '#D9E1F2', 'border': 1})
-
-    # Escribir encabezados
-    for col_num, header in enumerate(headers):
-        worksheet.write(0, col_num, header, header_format)
-
-    # Escribir datos
-    row_num = 1
-    for dia in datos_historial:
-        col_num = 0
-        # Columna 0: Fecha
-        worksheet.write(row_num, col_num, dia.get('fecha', ''))
-        col_num += 1
-        # Columna 1: Día
-        worksheet.write(row_num, col_num, dia.get('nombre_dia', ''))
-        col_num += 1
-        # Columnas de Festivos eliminadas (continuamos desde T Max)
-        # Columna 2: T Max
-        worksheet.write(row_num, col_num, dia.get('tmax', ''))
-        col_num += 1
-        # Columna 3: T Min
-        worksheet.write(row_num, col_num, dia.get('tmin', ''))
-        col_num += 1
-        # Columna 4: Precipitación
-        worksheet.write(row_num, col_num, dia.get('precipitacion_mm', ''))
-        col_num += 1
-        # Columna 5: Viento
-        worksheet.write(row_num, col_num, dia.get('viento_kmh', ''))
-        col_num += 1
-        # Columna 6: Condiciones
-        worksheet.write(row_num, col_num, dia.get('condiciones', ''))
-        col_num += 1
-        # Columna 7: Nubosidad
-        worksheet.write(row_num, col_num, dia.get('nubosidad_perc', ''))
-        col_num += 1
-        row_num += 1
-
-    # AJUSTE: Usar worksheet.autofit() para ajustar todas las columnas
-    worksheet.autofit()
 
+def escribir_hoja_xlsx(workbook, nombre_hoja, serie, formatos):
+    """Escribe una hoja fila a fila (orden requerido por constant_memory) con celdas tipadas."""
+    # Nombre de hoja: máximo 31 caracteres y sin los caracteres reservados de Excel
+    nombre_hoja = ''.join('_' if c in '[]:*?/\\' else c for c in nombre_hoja)[:31]
+    worksheet = workbook.add_worksheet(nombre_hoja)
+    for col_num, (header, ancho) in enumerate(COLUMNAS_XLSX):
+        worksheet.set_column(col_num, col_num, ancho)
+        worksheet.write_string(0, col_num, header, formatos['encabezado'])
+
+    fechas = serie.fechas.tolist()  # datetime.date
+    nombres_dia = serie.nombres_dia.tolist()
+    condiciones = serie.condiciones.tolist()
+    numericas = [col.tolist() for col in (serie.tmax, serie.tmin, serie.precipitacion, serie.viento)]
+    formato_numero = formatos['numero']
+    for i in range(len(fechas)):
+        fila = i + 1
+        worksheet.write_datetime(fila, 0, fechas[i], formatos['fecha'])
+        worksheet.write_string(fila, 1, nombres_dia[i])
+        for j, columna in enumerate(numericas, start=2):
+            valor = columna[i]
+            if valor == valor:  # NaN queda como celda vacía
+                worksheet.write_number(fila, j, valor, formato_numero)
+        worksheet.write_string(fila, 6, condiciones[i])
+        worksheet.write_number(fila, 7, 50)  # Nubosidad: dato simulado
+    return worksheet
+
+
+@medido('exportar_xlsx')
+def exportar_xlsx_stream(tienda_nombre, año_consulta, serie):
+    """Genera el XLSX con memoria constante sobre un archivo temporal y lo devuelve posicionado al inicio.
+
+    xlsxwriter escribe cada fila a disco en cuanto se completa (constant_memory) y el libro final
+    queda en un SpooledTemporaryFile, que solo pasa a disco si supera EXPORTACION_SPOOL_MAX_BYTES."""
+    archivo = tempfile.SpooledTemporaryFile(max_size=EXPORTACION_SPOOL_MAX_BYTES)
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(archivo, {'constant_memory': True})
+    escribir_hoja_xlsx(workbook, f'Clima_{tienda_nombre}', serie, formatos_xlsx(workbook))
     workbook.close()
-    buffer.seek(0)
-    return buffer
+    archivo.seek(0)
+    return archivo
+
+
+def leer_en_bloques(archivo, tamaño_bloque=TAMAÑO_BLOQUE_DESCARGA):
+    """Generador que entrega el archivo por bloques y lo cierra al terminar (o si se corta la descarga)."""
+    try:
+        while True:
+            bloque = archivo.read(tamaño_bloque)
+            if not bloque:
+                break
+            yield bloque
+    finally:
+        archivo.close()
+
+
+def respuesta_archivo(archivo, mimetype, nombre_descarga):
+    """Respuesta de descarga de un archivo temporal ya generado: por bloques y con Content-Length."""
+    tamaño = archivo.seek(0, os.SEEK_END)
+    archivo.seek(0)
+    response = Response(leer_en_bloques(archivo), mimetype=mimetype)
+    # Con el nombre entre comillas, como lo dejaba send_file (los nombres de tienda llevan espacios)
+    response.headers.set('Content-Disposition', 'attachment', filename=nombre_descarga)
+    response.headers['Content-Length'] = str(tamaño)
+    return response
+
+
+RESULTADO_EXPIRADO = ("El resultado ya no está disponible en el servidor. Vuelva a consultar el historial "
+                      "para exportarlo.", 410)
 
 
 @app.route("/exportar_datos/<formato>", methods=["POST"])
 def exportar_datos(formato):
-    """Maneja la exportación a CSV y XLSX."""
-    datos_export_json = request.form.get('datos_export_json')
-    tienda_nombre = request.form.get('tienda_nombre')
-    año_consulta = request.form.get('año_consulta')
-
-    try:
-        datos_historial = json.loads(datos_export_json)
-    except json.JSONDecodeError:
-        return "Error al decodificar los datos para exportación.", 400
+    """Maneja la exportación a CSV y XLSX del resultado guardado en el servidor."""
+    guardado = leer_resultado(request.form.get('resultado_id'))
+    if guardado is None:
+        return RESULTADO_EXPIRADO
+    tienda_nombre, año_consulta, serie = guardado
 
-    if not datos_historial:
+    if not len(serie):
         return "No hay datos para exportar después de aplicar los filtros.", 404
 
     filename_base = f"Clima_{tienda_nombre}_{año_consulta}_{datetime.now().strftime('%Y%m%d')}"
 
     if formato == 'csv':
         response = Response(
-            stream_with_context(generate_csv_rows(datos_historial)),
+            stream_with_context(cronometrar_generador('exportar_csv', generate_csv_rows(serie))),
             mimetype='text/csv'
         )
         response.headers['Content-Disposition'] = f'attachment; filename={filename_base}.csv'
         return response
 
     elif formato == 'excel':
-        buffer = exportar_xlsx_stream(tienda_nombre, año_consulta, datos_historial)
-        return send_file(
-            buffer,
-            as_attachment=True,
-            download_name=f"{filename_base}.xlsx",
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        archivo = exportar_xlsx_stream(tienda_nombre, año_consulta, serie)
+        return respuesta_archivo(archivo, XLSX_MIMETYPE, f"{filename_base}.xlsx")
+
+    return "Formato de exportación no soportado.", 400
+
+
+# -------------------------------------------------------------------------
+# Motor de reportes PDF (tablas)
+# -------------------------------------------------------------------------
+# Los días se dibujan como filas de LongTable con celdas de texto plano: ReportLab no tiene
+# que interpretar marcado de Paragraph por cada día, que era lo más lento del reporte.
+FILAS_POR_TABLA_PDF = 500
+ENCABEZADOS_PDF = ['Fecha', 'Día', 'T Máx (°C)', 'T Mín (°C)', 'Lluvia (mm)', 'Viento (km/h)', 'Condiciones']
+ANCHOS_COLUMNA_PDF = [58, 52, 50, 50, 52, 58, 190]
+
+
+@lru_cache(maxsize=None)
+def motor_pdf():
+    """Importa ReportLab y arma los estilos del reporte la primera vez que se genera un PDF en el proceso."""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import LongTable, PageBreak, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+    estilo_tabla_dias = TableStyle([
+        ('FONT', (0, 0), (-1, -1), 'Helvetica', 7.5),
+        ('FONT', (0, 0), (-1, 0), 'Helvetica-Bold', 7.5),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#D9E1F2')),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F5F7FA')]),
+        ('ALIGN', (2, 0), (5, -1), 'RIGHT'),
+        ('LINEBELOW', (0, 0), (-1, 0), 0.5, colors.HexColor('#9CA3AF')),
+        ('TOPPADDING', (0, 0), (-1, -1), 1.5),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 1.5),
+    ])
+    estilo_tabla_resumen = TableStyle([
+        ('FONT', (0, 0), (-1, -1), 'Helvetica', 9),
+        ('FONT', (0, 0), (-1, 0), 'Helvetica-Bold', 9),
+        ('FONT', (0, 1), (0, -1), 'Helvetica-Bold', 9),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#D9E1F2')),
+        ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.HexColor('#D1D5DB')),
+    ])
+    return SimpleNamespace(LongTable=LongTable, PageBreak=PageBreak, Paragraph=Paragraph,
+                           SimpleDocTemplate=SimpleDocTemplate, Spacer=Spacer, Table=Table, letter=letter,
+                           estilos=getSampleStyleSheet(), estilo_tabla_dias=estilo_tabla_dias,
+                           estilo_tabla_resumen=estilo_tabla_resumen)
+
+
+def _texto_columna(columna, formato='%.1f'):
+    """Formatea una columna numérica como texto de forma vectorizada ('-' para NaN)."""
+    return np.where(np.isnan(columna), '-', np.char.mod(formato, columna)).tolist()
+
+
+def _estadistica(columna, funcion):
+    validos = columna[~np.isnan(columna)]
+    return f"{funcion(validos):.1f}" if len(validos) else '-'
+
+
+def tabla_resumen_pdf(serie):
+    """Tabla de estadísticas (promedio, mínimo, máximo) por variable, más conteos de días."""
+    filas = [['Variable', 'Promedio', 'Mínimo', 'Máximo']]
+    for etiqueta, columna in (('T Máx (°C)', serie.tmax), ('T Mín (°C)', serie.tmin),
+                              ('Lluvia (mm)', serie.precipitacion), ('Viento (km/h)', serie.viento)):
+        filas.append([etiqueta, _estadistica(columna, np.mean), _estadistica(columna, np.min),
+                      _estadistica(columna, np.max)])
+    filas.append(['Lluvia total (mm)', _estadistica(serie.precipitacion, np.sum), '', ''])
+    filas.append([f'Días con lluvia >= {UMBRAL_DIA_LLUVIOSO_MM:g} mm',
+                  str(int(np.sum(serie.precipitacion >= UMBRAL_DIA_LLUVIOSO_MM))), '', ''])
+    conteo = np.bincount(serie.indice_condicion, minlength=len(CONDICIONES))
+    for condicion, cantidad in zip(CONDICIONES, conteo):
+        if cantidad:
+            filas.append([f'Días: {condicion}', str(int(cantidad)), '', ''])
+    pdf = motor_pdf()
+    return pdf.Table(filas, colWidths=[230, 80, 80, 80], style=pdf.estilo_tabla_resumen, hAlign='LEFT')
+
+
+def historia_pdf_tienda(tienda_nombre, periodo, serie):
+    """Flowables del reporte de una tienda: página de resumen y tablas de días."""
+    pdf = motor_pdf()
+    if len(serie):
+        rango = (f"Desde {np.datetime_as_string(serie.fechas[0], unit='D')} "
+                 f"hasta {np.datetime_as_string(serie.fechas[-1], unit='D')}")
+    else:
+        rango = "Sin datos"
+    historia = [
+        pdf.Paragraph(f"<b>Reporte Climático Detallado para: {escape(tienda_nombre)} ({escape(str(periodo))})</b>",
+                      pdf.estilos['Heading1']),
+        pdf.Paragraph(f"Rango de fechas consultado: {rango}.", pdf.estilos['Normal']),
+        pdf.Paragraph(f"Generado el: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", pdf.estilos['Normal']),
+        pdf.Paragraph(f"Días incluidos en el reporte (tras filtros): {len(serie)}", pdf.estilos['Normal']),
+        pdf.Spacer(1, 12),
+    ]
+    if not len(serie):
+        return historia + [pdf.PageBreak()]
+    historia += [tabla_resumen_pdf(serie), pdf.PageBreak()]
+
+    columnas = list(zip(np.datetime_as_string(serie.fechas, unit='D').tolist(), serie.nombres_dia.tolist(),
+                        _texto_columna(serie.tmax), _texto_columna(serie.tmin),
+                        _texto_columna(serie.precipitacion), _texto_columna(serie.viento),
+                        serie.condiciones.tolist()))
+    # Tablas de tamaño acotado: el coste de dividir una LongTable entre páginas crece con su tamaño
+    for inicio in range(0, len(columnas), FILAS_POR_TABLA_PDF):
+        historia.append(pdf.LongTable([ENCABEZADOS_PDF] + columnas[inicio:inicio + FILAS_POR_TABLA_PDF],
+                                      colWidths=ANCHOS_COLUMNA_PDF, repeatRows=1, style=pdf.estilo_tabla_dias))
+    historia.append(pdf.PageBreak())
+    return historia
+
+
+def historia_pdf_omitidas(omitidas):
+    """Página final con las tiendas que no se pudieron incluir en el reporte y el motivo."""
+    pdf = motor_pdf()
+    historia = [pdf.Paragraph("<b>Tiendas omitidas del reporte</b>", pdf.estilos['Heading1'])]
+    for tienda, error in omitidas:
+        historia.append(pdf.Paragraph(f"<b>{escape(tienda)}</b>: {escape(str(error))}", pdf.estilos['Normal']))
+    return historia
+
+
+class _HistoriaPorTiendas(list):
+    """Lista de flowables que se rellena con la siguiente tienda solo cuando se agota la anterior.
+
+    doc.build() consume la lista desde el principio y consulta len() en cada vuelta, así que
+    en memoria solo están los flowables de la tienda que se está maquetando."""
+
+    def __init__(self, secciones):
+        super().__init__()
+        self._secciones = iter(secciones)
+
+    def __len__(self):
+        while not super().__len__():
+            siguiente = next(self._secciones, None)
+            if siguiente is None:
+                break
+            self.extend(siguiente)
+        return super().__len__()
+
+
+@medido('exportar_pdf')
+def generar_pdf_reporte(secciones, titulo, omitidas=()):
+    """Genera el PDF a partir de un iterable de (tienda, periodo, serie) en un archivo temporal.
+
+    'omitidas' es una lista de (tienda, error) que puede irse llenando mientras se consumen las
+    secciones; si al final no está vacía, el reporte termina con una página que las enumera.
+    Devuelve el archivo posicionado al inicio, listo para leer_en_bloques."""
+
+    def _historias():
+        for seccion in secciones:
+            yield historia_pdf_tienda(*seccion)
+        if omitidas:
+            yield historia_pdf_omitidas(omitidas)
+
+    pdf = motor_pdf()
+    archivo = tempfile.SpooledTemporaryFile(max_size=EXPORTACION_SPOOL_MAX_BYTES)
+    doc = pdf.SimpleDocTemplate(archivo, pagesize=pdf.letter, title=titulo,
+                                leftMargin=36, rightMargin=36, topMargin=36, bottomMargin=36)
+    doc.build(_HistoriaPorTiendas(_historias()))
+    archivo.seek(0)
+    return archivo
+
+
+# -------------------------------------------------------------------------
+# Exportación masiva (varias tiendas y años)
+# -------------------------------------------------------------------------
+ENCABEZADOS_CSV_LOTE = ['Tienda', 'Fecha', 'Dia', 'T Max (°C)', 'T Min (°C)', 'Precipitacion (mm)',
+                        'Viento Max (km/h)', 'Condiciones', 'Nubosidad (%)']
+
+
+def resolver_tiendas(seleccion):
+    """Interpreta la selección de tiendas: 'todas', un grupo de TIENDAS_AGRUPADAS o una lista separada por comas.
+
+    Devuelve la lista de nombres o un dict de error."""
+    seleccion = (seleccion or 'todas').strip()
+    if seleccion.lower() == 'todas':
+        return list(TIENDAS_MAP)
+    if seleccion in TIENDAS_AGRUPADAS:
+        return list(TIENDAS_AGRUPADAS[seleccion])
+    nombres = [nombre.strip() for nombre in seleccion.split(',') if nombre.strip()]
+    desconocidas = [nombre for nombre in nombres if nombre not in TIENDAS_MAP]
+    if not nombres or desconocidas:
+        return {"error": f"Tiendas no reconocidas: {', '.join(desconocidas) or seleccion}."}
+    return nombres
+
+
+def resolver_rango_años(año_desde, año_hasta):
+    """Valida el rango de años pedido y devuelve la lista de años, o un dict de error."""
+    año_actual = datetime.now().year
+    try:
+        desde = int(año_desde or año_actual)
+        hasta = int(año_hasta or desde)
+    except ValueError:
+        return {"error": "El rango de años no es válido."}
+    if desde > hasta or desde < 2015 or hasta > año_actual:
+        return {"error": f"Rango de años no válido; debe estar dentro de 2015-{año_actual}."}
+    return list(range(desde, hasta + 1))
+
+
+def _historial_varios_años(coordenadas, años):
+    """Series de varias coordenadas con todos los años concatenados (o el primer error de cada una)."""
+    por_coordenada = [[] for _ in coordenadas]
+    for año in años:
+        for i, resultado in enumerate(obtener_historial_lote(coordenadas, año)):
+            por_coordenada[i].append(resultado)
+    resultados = []
+    for partes in por_coordenada:
+        error = next((p for p in partes if isinstance(p, dict)), None)
+        resultados.append(error or SerieClimatica.concatenar(partes))
+    return resultados
+
+
+def historial_tiendas_a_medida(nombres, años):
+    """Generador de (tienda, serie o dict de error) en el orden en que terminan las descargas.
+
+    Las celdas del archivo de las tiendas se reparten en lotes multi-coordenada sobre el pool
+    compartido, de modo que la primera tienda lista puede enviarse al cliente mientras las
+    demás siguen descargándose; las tiendas de una misma celda comparten la serie."""
+    por_celda = agrupar_por_celda({nombre: TIENDAS_MAP[nombre] for nombre in nombres})
+    celdas = list(por_celda)
+    lotes = [celdas[i:i + ARCHIVO_TAMAÑO_LOTE] for i in range(0, len(celdas), ARCHIVO_TAMAÑO_LOTE)]
+    futuros = {POOL_DESCARGAS.submit(_historial_varios_años, lote, años): lote for lote in lotes}
+    try:
+        for futuro in as_completed(futuros):
+            lote = futuros[futuro]
+            for celda, serie in zip(lote, resultados_lote(futuro, len(lote))):
+                for nombre in por_celda[celda]:
+                    yield nombre, serie
+    finally:
+        # Si el cliente corta la descarga, los lotes que no empezaron no se procesan
+        for futuro in futuros:
+            futuro.cancel()
+
+
+def filas_serie(serie):
+    """Filas (listas) de la serie en el orden de las columnas de exportación, sin pasar por dicts."""
+    fechas = np.datetime_as_string(serie.fechas, unit='D').tolist()
+    nombres_dia = serie.nombres_dia.tolist()
+    condiciones = serie.condiciones.tolist()
+    tmax, tmin, precip, viento = (np.where(np.isnan(col), '', col).tolist()
+                                  for col in (serie.tmax, serie.tmin, serie.precipitacion, serie.viento))
+    for i in range(len(fechas)):
+        yield [fechas[i], nombres_dia[i], tmax[i], tmin[i], precip[i], viento[i], condiciones[i], 50]
+
+
+def _csv_texto(filas):
+    output = StringIO()
+    csv.writer(output).writerows(filas)
+    return output.getvalue()
+
+
+def fila_error_csv_lote(tienda, error):
+    """Fila del CSV masivo para una tienda sin datos: sin fecha ni valores, con el error en Condiciones."""
+    fila = [tienda] + [''] * (len(ENCABEZADOS_CSV_LOTE) - 1)
+    fila[ENCABEZADOS_CSV_LOTE.index('Condiciones')] = f"ERROR: {error}"
+    return fila
+
+
+def generar_csv_lote(nombres, años):
+    """Genera un único CSV con la columna Tienda, enviando cada tienda en cuanto está lista.
+
+    Una tienda que no se pudo obtener aparece como una fila de error (ver fila_error_csv_lote),
+    ya que con la respuesta en curso no se puede cambiar el estado HTTP."""
+    yield _csv_texto([ENCABEZADOS_CSV_LOTE])
+    for tienda, serie in historial_tiendas_a_medida(nombres, años):
+        if isinstance(serie, dict):
+            logger.warning("Exportación masiva: se omite %s: %s", tienda, serie['error'])
+            yield _csv_texto([fila_error_csv_lote(tienda, serie['error'])])
+            continue
+        yield _csv_texto([tienda, *fila] for fila in filas_serie(serie))
+
+
+class _SalidaZip:
+    """Destino de escritura no posicionable para zipfile: acumula lo escrito para entregarlo por partes."""
+
+    def __init__(self):
+        self._partes = []
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def flush(self):
+        pass
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes.clear()
+        return datos
+
+
+def generar_zip_lote(nombres, años):
+    """Genera un ZIP con un CSV por tienda, enviando cada archivo en cuanto está listo.
+
+    Como la salida no es posicionable, zipfile usa descriptores de datos y no necesita
+    tener el ZIP completo en memoria."""
+    salida = _SalidaZip()
+    errores = []
+    sufijo = f"{años[0]}-{años[-1]}" if len(años) > 1 else str(años[0])
+    with zipfile.ZipFile(salida, 'w', compression=zipfile.ZIP_DEFLATED) as archivo_zip:
+        for tienda, serie in historial_tiendas_a_medida(nombres, años):
+            if isinstance(serie, dict):
+                errores.append(f"{tienda}: {serie['error']}")
+                continue
+            with archivo_zip.open(f"Clima_{tienda}_{sufijo}.csv", 'w') as destino:
+                destino.write(_csv_texto([ENCABEZADOS_CSV_LOTE[1:], *filas_serie(serie)]).encode('utf-8'))
+            yield salida.vaciar()
+        if errores:
+            archivo_zip.writestr("ERRORES.txt", "\n".join(errores) + "\n")
+    yield salida.vaciar()
+
+
+@app.route("/exportar_lote/<formato>", methods=["GET", "POST"])
+def exportar_lote(formato):
+    """Exporta varias tiendas y años: ?tiendas=todas|Shopping|Templo|<lista>&año_desde=AAAA&año_hasta=AAAA.
+
+    formato 'csv' devuelve un único CSV con la columna Tienda; 'zip' un ZIP con un CSV por tienda;
+    'pdf' un reporte con una sección (resumen y tabla de días) por tienda."""
+    parametros = request.values
+    nombres = resolver_tiendas(parametros.get('tiendas'))
+    if isinstance(nombres, dict):
+        return nombres['error'], 400
+    años = resolver_rango_años(parametros.get('año_desde'), parametros.get('año_hasta'))
+    if isinstance(años, dict):
+        return años['error'], 400
+
+    filename_base = f"Clima_lote_{años[0]}-{años[-1]}_{datetime.now().strftime('%Y%m%d')}"
+    if formato == 'csv':
+        contenido = cronometrar_generador('exportar_csv_lote', generar_csv_lote(nombres, años))
+        response = Response(stream_with_context(contenido), mimetype='text/csv')
+        response.headers['Content-Disposition'] = f'attachment; filename={filename_base}.csv'
+        return response
+    elif formato == 'zip':
+        contenido = cronometrar_generador('exportar_zip_lote', generar_zip_lote(nombres, años))
+        response = Response(stream_with_context(contenido), mimetype='application/zip')
+        response.headers['Content-Disposition'] = f'attachment; filename={filename_base}.zip'
+        return response
+    elif formato == 'pdf':
+        periodo = f"{años[0]}-{años[-1]}" if len(años) > 1 else str(años[0])
+        # El PDF se arma entero antes de responder: las tiendas van en el orden pedido, no en el de llegada
+        series = dict(historial_tiendas_a_medida(nombres, años))
+        omitidas = [(nombre, series[nombre]['error']) for nombre in nombres if isinstance(series[nombre], dict)]
+        secciones = ((nombre, periodo, series[nombre]) for nombre in nombres if not isinstance(series[nombre], dict))
+        archivo = generar_pdf_reporte(secciones, titulo=f"Reporte Climático de {len(nombres)} tiendas - {periodo}",
+                                      omitidas=omitidas)
+        return respuesta_archivo(archivo, 'application/pdf', f"{filename_base}.pdf")
 
     return "Formato de exportación no soportado.", 400
 
 
 @app.route("/generar_pdf", methods=["POST"])
 def generar_pdf():
-    # Obtener el año y el rango de fechas para el PDF
-    datos_pdf_json = request.form.get('datos_pdf_json')
-    tienda_nombre = request.form.get('tienda_nombre')
-    año_consulta = request.form.get('año_consulta')
+    """Genera el PDF del resultado guardado: resumen estadístico y tabla de días."""
+    guardado = leer_resultado(request.form.get('resultado_id'))
+    if guardado is None:
+        return RESULTADO_EXPIRADO
+    tienda_nombre, año_consulta, serie = guardado
+
+    archivo = generar_pdf_reporte([(tienda_nombre, año_consulta, serie)],
+                                  titulo=f"Reporte Climático {tienda_nombre} - {año_consulta}")
+    return respuesta_archivo(
+        archivo, 'application/pdf',
+        f"Reporte_Climatico_{tienda_nombre}_{año_consulta}_{datetime.now().strftime('%Y%m%d')}.pdf")
+
+
+# -------------------------------------------------------------------------
+# API de datos (JSON columnar / NDJSON)
+# -------------------------------------------------------------------------
+# /api/historial entrega la serie procesada sin pasar por las plantillas. El ETag resume el
+# rango de fechas y el contenido de cada serie y Last-Modified sale del último día con datos,
+# así un job puede repetir la consulta con If-None-Match / If-Modified-Since y recibir 304.
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def validadores_historial(series, variante):
+    """ETag y Last-Modified de una respuesta de /api/historial.
+
+    'variante' distingue representaciones de la misma consulta (formato, filtros). Devuelve
+    (None, None) si alguna tienda falló, para que no se guarde en caché una respuesta incompleta."""
+    huella = hashlib.sha256(variante.encode())
+    ultimo_dia = None
+    for nombre, serie in series:
+        if isinstance(serie, dict):
+            return None, None
+        huella.update(nombre.encode())
+        if len(serie):
+            desde, hasta = serie.fechas.min(), serie.fechas.max()
+            ultimo_dia = hasta if ultimo_dia is None else max(ultimo_dia, hasta)
+            huella.update(f"{desde}/{hasta}/{len(serie)}".encode())
+        for campo in SerieClimatica.__slots__:
+            huella.update(getattr(serie, campo).tobytes())
+    last_modified = None
+    if ultimo_dia is not None:
+        # Fin del último día con datos (medianoche UTC siguiente), sin pasar de ahora
+        fin_dia = datetime.fromisoformat(str(ultimo_dia + 1)).replace(tzinfo=timezone.utc)
+        last_modified = min(fin_dia, datetime.now(timezone.utc).replace(microsecond=0))
+    return huella.hexdigest()[:32], last_modified
+
+
+def _tienda_api(nombre, serie):
+    lat, lon = TIENDAS_MAP[nombre]
+    entrada = {'tienda': nombre, 'tipo': nombre.split()[0], 'lat': lat, 'lon': lon}
+    if isinstance(serie, dict):
+        entrada['error'] = serie['error']
+    else:
+        entrada['dias'] = len(serie)
+        entrada.update(serie.a_columnas())
+    return entrada
 
-    try:
-        datos_historial = json.loads(datos_pdf_json)
-    except json.JSONDecodeError:
-        return "Error al decodificar los datos para PDF.", 400
-
-    # Calcular el rango de fechas real
-    if datos_historial:
-        fecha_inicio_reporte = datos_historial[0]['fecha']
-        fecha_fin_reporte = datos_historial[-1]['fecha']
+
+def generar_json_historial(series, años):
+    """JSON columnar (una lista por columna y tienda), enviado tienda por tienda."""
+    yield json.dumps({'año_desde': años[0], 'año_hasta': años[-1]})[:-1] + ', "tiendas": ['
+    for i, (nombre, serie) in enumerate(series):
+        yield (', ' if i else '') + json.dumps(_tienda_api(nombre, serie))
+    yield ']}'
+
+
+def generar_ndjson_historial(series):
+    """NDJSON: una línea por día con su tienda (o una línea con el error de la tienda)."""
+    for nombre, serie in series:
+        if isinstance(serie, dict):
+            yield json.dumps({'tienda': nombre, 'error': serie['error']}) + '\n'
+            continue
+        columnas = serie.a_columnas()
+        claves = list(columnas)
+        yield ''.join(json.dumps({'tienda': nombre, **dict(zip(claves, fila))}) + '\n'
+                      for fila in zip(*columnas.values()))
+
+
+@app.route("/api/historial", methods=["GET"])
+def api_historial():
+    """Serie diaria procesada: ?tiendas=todas|Shopping|Templo|<lista>&año_desde=AAAA&año_hasta=AAAA&formato=json|ndjson.
+
+    Acepta además los filtros del formulario (tmax_min, tmin_max, condiciones_filtro, dias_semana,
+    nulos, ...) y responde 304 si el ETag o la fecha de If-Modified-Since siguen vigentes."""
+    parametros = request.args
+    formato = parametros.get('formato', 'json')
+    if formato not in ('json', 'ndjson'):
+        return jsonify({"error": f"Formato no soportado: '{formato}'."}), 400
+    nombres = resolver_tiendas(parametros.get('tiendas'))
+    if isinstance(nombres, dict):
+        return jsonify(nombres), 400
+    años = resolver_rango_años(parametros.get('año_desde'), parametros.get('año_hasta'))
+    if isinstance(años, dict):
+        return jsonify(años), 400
+    filtro = compilar_filtros(leer_filtros_formulario(parametros, años[0]))
+    if isinstance(filtro, dict):
+        return jsonify(filtro), 400
+
+    obtenidas = dict(historial_tiendas_a_medida(nombres, años))
+    series = []
+    for nombre in nombres:
+        serie = obtenidas[nombre]
+        series.append((nombre, serie if isinstance(serie, dict) else filtro.aplicar(serie)))
+    etag, last_modified = validadores_historial(series, json.dumps(sorted(parametros.items(multi=True))))
+    if etag is not None and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    elif formato == 'ndjson':
+        contenido = cronometrar_generador('api_historial', generar_ndjson_historial(series))
+        response = Response(stream_with_context(contenido), mimetype=NDJSON_MIMETYPE)
     else:
-        # Usamos el año_consulta directamente si no hay datos
-        fecha_inicio_reporte = f"01-01-{año_consulta}"
-        fecha_fin_reporte = "Sin datos"
-
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter, title=f"Reporte Climático {tienda_nombre} - {año_consulta}")
-    styles = getSampleStyleSheet()
-    styles.add(ParagraphStyle(name='Data', fontSize=10, leading=12))
-    story = []
-
-    story.append(
-        Paragraph(f"<b>Reporte Climático Detallado para: {tienda_nombre} ({año_consulta})</b>", styles['Heading1']))
-    story.append(
-        Paragraph(f"Rango de fechas consultado: Desde {fecha_inicio_reporte} hasta {fecha_fin_reporte}.",
-                  styles['Normal']))
-    story.append(Paragraph(f"Generado el: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['Normal']))
-    story.append(Paragraph(f"Días incluidos en el reporte (tras filtros): {len(datos_historial)}", styles['Normal']))
-    story.append(Paragraph("<br/>", styles['Normal']))
-
-    for dia in datos_historial:
-        # La información de festivos ha sido eliminada del PDF
-        dia_semana = dia.get('nombre_dia', '')
-        linea = (
-            f"<b>Fecha:</b> {dia.get('fecha')} ({dia_semana}) | <b>T Max/Min:</b> {dia.get('tmax')}/{dia.get('tmin')} °C | "
-            f"<b>Lluvia:</b> {dia.get('precipitacion_mm')} mm | <b>Viento:</b> {dia.get('viento_kmh')} km/h | "
-            f"<b>Condiciones:</b> {dia.get('condiciones', 'N/A')}")
-        story.append(Paragraph(linea, styles['Data']))
-
-    doc.build(story)
-    buffer.seek(0)
-    return send_file(
-        buffer, as_attachment=True,
-        download_name=f"Reporte_Climatico_{tienda_nombre}_{año_consulta}_{datetime.now().strftime('%Y%m%d')}.pdf",
-        mimetype='application/pdf'
-    )
+        contenido = cronometrar_generador('api_historial', generar_json_historial(series, años))
+        response = Response(stream_with_context(contenido), mimetype='application/json')
+    if etag is not None:
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # Se puede guardar, pero hay que revalidar siempre (el año en curso cambia a diario)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+# =========================================================================
+# 5. COMANDOS CLI Y TAREAS EN SEGUNDO PLANO
+# =========================================================================
+
+@app.cli.command("refrescar-ranking")
+@click.option("--año", "años", type=int, multiple=True,
+              help="Año a recalcular (se puede repetir). Por defecto, el último con días publicados.")
+def refrescar_ranking_cli(años):
+    """Recalcula y guarda los snapshots del ranking (pensado para ejecutarse desde cron)."""
+    for año in años or (año_con_datos(),):
+        ranking_data = refrescar_ranking(año)
+        if ranking_data.get('error'):
+            click.echo(f"{año}: {ranking_data['error']}", err=True)
+        else:
+            estado = "parcial" if ranking_data.get('parcial') else "completo"
+            click.echo(f"{año}: snapshot {estado} generado el {ranking_data['generado_en']}")
+
+
+@app.cli.command("indexar-celdas")
+@click.option("--purgar", is_flag=True, help="Borrar de la caché los días de tiendas que dejan de ser representativas.")
+def indexar_celdas_cli(purgar):
+    """Vuelve a preguntar al archivo la celda de rejilla de todas las tiendas (se aprenden solas en la
+    primera descarga; esto sirve para verificarlas o para purgar la caché tras agrupar)."""
+    descubrir_celdas(forzar=True)
+    click.echo(f"{len(TIENDAS_MAP)} tiendas en {len(REPRESENTANTES_CELDA)} celdas")
+    if purgar:
+        click.echo(f"{purgar_cache_celdas()} días borrados de la caché")
+
+
+if RANKING_REFRESCO_SEGUNDOS > 0:
+    iniciar_refresco_periodico()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+"""Arranque y memoria residente de un worker: importación diferida frente a anticipada de las exportaciones.
+
+Cada medición es un proceso nuevo, como un worker de gunicorn recién arrancado. Se mide el tiempo
+de 'import app', la memoria residente (RSS) tras la importación y tras una vista de página, y el
+coste del primer XLSX y del primer PDF. El perfil 'anticipada' importa ReportLab y xlsxwriter
+(y arma los estilos del PDF) antes que la app, como hacía la app al importar estas librerías
+en el propio módulo.
+
+Uso:
+    python benchmarks/arranque.py [--repeticiones 5]
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PERFILES = ('diferida', 'anticipada')
+
+
+def rss_mb():
+    """Memoria residente actual del proceso en MB (pico si no hay /proc)."""
+    try:
+        with open('/proc/self/status') as estado:
+            for linea in estado:
+                if linea.startswith('VmRSS:'):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def medir_proceso(perfil):
+    """Se ejecuta en el proceso hijo: imprime un JSON con las mediciones de un arranque."""
+    sys.path.insert(0, RAIZ)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    resultado = {}
+
+    inicio = time.perf_counter()
+    if perfil == 'anticipada':
+        import xlsxwriter  # noqa: F401
+        from reportlab.platypus import SimpleDocTemplate  # noqa: F401
+    import app
+    if perfil == 'anticipada':
+        app.motor_pdf()
+    resultado['import'] = time.perf_counter() - inicio
+    resultado['rss_import'] = rss_mb()
+
+    # La portada solo renderiza el formulario: no consulta el archivo
+    respuesta = app.app.test_client().get('/')
+    if respuesta.status_code != 200:
+        raise RuntimeError(f"GET / respondió {respuesta.status_code}")
+    resultado['rss_vista'] = rss_mb()
+
+    import servidor_simulado
+    diario = servidor_simulado.diario_sintetico(7.06, -73.87, '2023-01-01', '2023-12-31')
+    serie = app.SerieClimatica.desde_diario(diario)
+    inicio = time.perf_counter()
+    app.exportar_xlsx_stream('Shopping 1', 2023, serie).close()
+    resultado['primer_xlsx'] = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    app.generar_pdf_reporte([('Shopping 1', 2023, serie)], 'Shopping 1').close()
+    resultado['primer_pdf'] = time.perf_counter() - inicio
+    resultado['rss_exportar'] = rss_mb()
+    print(json.dumps(resultado))
+
+
+def medir(perfil, repeticiones):
+    mediciones = []
+    with tempfile.TemporaryDirectory() as directorio:
+        entorno = dict(os.environ, CLIMA_CACHE_DB=os.path.join(directorio, 'cache.sqlite3'), LOG_LEVEL='WARNING')
+        for _ in range(repeticiones):
+            salida = subprocess.run([sys.executable, os.path.abspath(__file__), '--hijo', perfil], env=entorno,
+                                    cwd=RAIZ, check=True, capture_output=True, text=True).stdout
+            mediciones.append(json.loads(salida.strip().splitlines()[-1]))
+    return {clave: statistics.median(m[clave] for m in mediciones) for clave in mediciones[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeticiones', type=int, default=5, help="Procesos por perfil (se informa la mediana).")
+    parser.add_argument('--hijo', choices=PERFILES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.hijo:
+        medir_proceso(args.hijo)
+        return
+
+    print(f"Mediana de {args.repeticiones} procesos por perfil (RSS en MB, tiempos en s)")
+    print(f"{'importación':<12} {'import':>7} {'RSS import':>11} {'RSS vista':>10} "
+          f"{'1er XLSX':>9} {'1er PDF':>8} {'RSS export':>11}")
+    for perfil in PERFILES:
+        r = medir(perfil, args.repeticiones)
+        print(f"{perfil:<12} {r['import']:>7.3f} {r['rss_import']:>11.1f} {r['rss_vista']:>10.1f} "
+              f"{r['primer_xlsx']:>9.3f} {r['primer_pdf']:>8.3f} {r['rss_exportar']:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark del motor de reportes PDF.
+
+Mide el tiempo de generación para 365 filas (una tienda, un año) y 42×365 filas (todas las
+tiendas) con datos sintéticos, sin llamar a la API. Con --comparar también mide el método
+anterior (un Paragraph con marcado por día) como referencia.
+
+Uso:
+    python benchmarks/bench_pdf.py [--repeticiones 3] [--comparar]
+"""
+import argparse
+import os
+import resource
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+from reportlab.lib.pagesizes import letter  # noqa: E402
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet  # noqa: E402
+from reportlab.platypus import Paragraph, SimpleDocTemplate  # noqa: E402
+
+
+def serie_sintetica(dias, semilla):
+    """Serie de un año con valores plausibles y algunos nulos."""
+    rng = np.random.default_rng(semilla)
+    fechas = np.datetime64('2024-01-01') + np.arange(dias)
+    tmax = rng.normal(30, 3, dias).round(1)
+    tmax[rng.random(dias) < 0.01] = np.nan
+    return app.SerieClimatica(fechas, tmax, rng.normal(20, 2, dias).round(1),
+                              rng.gamma(0.6, 6, dias).round(1), rng.uniform(3, 35, dias).round(1),
+                              rng.choice([0, 1, 2, 3, 45, 51, 61, 80, 95], dias).astype(float))
+
+
+def pdf_tablas(secciones):
+    archivo = app.generar_pdf_reporte(secciones, titulo="Benchmark")
+    tamaño = archivo.seek(0, os.SEEK_END)
+    archivo.close()
+    return tamaño
+
+
+def pdf_paragraph_por_dia(secciones):
+    """Réplica del generador anterior: un Paragraph con marcado inline por día."""
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter)
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(name='Data', fontSize=10, leading=12))
+    story = []
+    for tienda, periodo, serie in secciones:
+        story.append(Paragraph(f"<b>Reporte Climático Detallado para: {tienda} ({periodo})</b>", styles['Heading1']))
+        for dia in serie.a_filas():
+            story.append(Paragraph(
+                f"<b>Fecha:</b> {dia['fecha']} ({dia['nombre_dia']}) | <b>T Max/Min:</b> {dia['tmax']}/{dia['tmin']} °C | "
+                f"<b>Lluvia:</b> {dia['precipitacion_mm']} mm | <b>Viento:</b> {dia['viento_kmh']} km/h | "
+                f"<b>Condiciones:</b> {dia['condiciones']}", styles['Data']))
+    doc.build(story)
+    return len(buffer.getvalue())
+
+
+def medir(funcion, tiendas, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        secciones = ((f"Tienda {i + 1}", '2024', serie_sintetica(365, i)) for i in range(tiendas))
+        inicio = time.perf_counter()
+        tamaño = funcion(secciones)
+        tiempos.append(time.perf_counter() - inicio)
+    return min(tiempos), tamaño
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeticiones', type=int, default=3)
+    parser.add_argument('--comparar', action='store_true', help="medir también el método de un Paragraph por día")
+    args = parser.parse_args()
+
+    motores = [('tablas', pdf_tablas)]
+    if args.comparar:
+        motores.append(('paragraph_por_dia', pdf_paragraph_por_dia))
+    print(f"{'motor':<20}{'filas':>8}{'segundos':>11}{'KiB':>9}")
+    for nombre, funcion in motores:
+        for tiendas in (1, 42):
+            segundos, tamaño = medir(funcion, tiendas, args.repeticiones)
+            print(f"{nombre:<20}{tiendas * 365:>8}{segundos:>11.3f}{tamaño / 1024:>9.0f}")
+    print(f"RSS máximo: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+
+
+if __name__ == '__main__':
+    main()
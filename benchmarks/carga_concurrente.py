@@ -0,0 +1,116 @@
+"""Prueba de carga: perfil de workers sync frente a gthread con el archivo simulado.
+
+Arranca el archivo simulado con latencia fija y, para cada perfil, un gunicorn con
+gunicorn.conf.py y una caché vacía. Después lanza consultas de historial concurrentes, cada
+una de una combinación (tienda, año) distinta para que todas vayan al archivo. Informa el
+rendimiento y las latencias de cada perfil.
+
+Uso:
+    python benchmarks/carga_concurrente.py [--peticiones 64] [--concurrencia 32] [--latencia 0.5]
+"""
+import argparse
+import itertools
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app  # noqa: E402
+import servidor_simulado  # noqa: E402
+
+PERFILES = {
+    'sync': {'GUNICORN_WORKER_CLASS': 'sync', 'GUNICORN_THREADS': '1'},
+    # Perfil tal como se despliega: hilos y conexiones por defecto de gunicorn.conf.py y app.py
+    'gthread': {'GUNICORN_WORKER_CLASS': 'gthread'},
+}
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def esperar_servidor(url, plazo=20):
+    limite = time.monotonic() + plazo
+    while time.monotonic() < limite:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"gunicorn no respondió en {url}")
+
+
+def consultas(total):
+    """(tienda, año) distintos: la caché vacía obliga a que cada una llame al archivo."""
+    combinaciones = itertools.product(range(2015, time.localtime().tm_year), app.TIENDAS_MAP)
+    return [(tienda, año) for año, tienda in itertools.islice(combinaciones, total)]
+
+
+def ejecutar_perfil(nombre, entorno_perfil, args, url_archivo):
+    puerto = puerto_libre()
+    with tempfile.TemporaryDirectory() as directorio:
+        # Sin los ajustes que pudiera traer el entorno, para medir solo lo que fija cada perfil
+        heredado = {clave: valor for clave, valor in os.environ.items()
+                    if clave not in ('GUNICORN_THREADS', 'ARCHIVO_POOL_CONEXIONES')}
+        entorno = dict(heredado, PORT=str(puerto), WEB_CONCURRENCY=str(args.workers),
+                       OPEN_METEO_ARCHIVE_URL=url_archivo, CLIMA_CACHE_DB=os.path.join(directorio, 'cache.sqlite3'),
+                       **entorno_perfil)
+        proceso = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                                   cwd=RAIZ, env=entorno, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            base = f"http://127.0.0.1:{puerto}"
+            esperar_servidor(base + '/')
+
+            def consultar(consulta):
+                tienda, año = consulta
+                inicio = time.perf_counter()
+                respuesta = requests.post(base + '/', data={'tienda': tienda, 'año_filtro': año}, timeout=300)
+                return time.perf_counter() - inicio, respuesta.status_code
+
+            inicio = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrencia) as pool:
+                resultados = list(pool.map(consultar, consultas(args.peticiones)))
+            duracion = time.perf_counter() - inicio
+        finally:
+            proceso.terminate()
+            proceso.wait(timeout=30)
+
+    latencias = sorted(r[0] for r in resultados)
+    errores = sum(1 for r in resultados if r[1] != 200)
+    p95 = latencias[max(0, int(len(latencias) * 0.95) - 1)]
+    print(f"{nombre:<9}{len(resultados) / duracion:>10.1f}{statistics.median(latencias):>10.2f}{p95:>10.2f}"
+          f"{duracion:>10.1f}{errores:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--peticiones', type=int, default=64)
+    parser.add_argument('--concurrencia', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--latencia', type=float, default=0.5, help="latencia del archivo simulado (s)")
+    parser.add_argument('--perfil', choices=sorted(PERFILES), action='append',
+                        help="perfil a medir (se puede repetir; por defecto todos)")
+    args = parser.parse_args()
+
+    servidor, url_archivo = servidor_simulado.iniciar(latencia=args.latencia)
+    print(f"{args.peticiones} peticiones, {args.concurrencia} clientes, {args.workers} workers, "
+          f"latencia del archivo {args.latencia:g} s")
+    print(f"{'perfil':<9}{'req/s':>10}{'p50 (s)':>10}{'p95 (s)':>10}{'total (s)':>10}{'errores':>8}")
+    for nombre in args.perfil or sorted(PERFILES, reverse=True):
+        ejecutar_perfil(nombre, PERFILES[nombre], args, url_archivo)
+    servidor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Sustituto local del archivo de Open-Meteo para benchmarks y pruebas de carga.
+
+Responde a /v1/archive con el mismo formato que la API real (incluidas las consultas
+multi-coordenada) y una latencia configurable. Sirve las respuestas grabadas del archivo real
+si hay grabación para la coordenada y los años pedidos, y si no datos sintéticos deterministas.
+
+Uso:
+    python benchmarks/servidor_simulado.py --puerto 8765 --latencia 0.3 [--grabaciones DIR]
+    OPEN_METEO_ARCHIVE_URL=http://127.0.0.1:8765/v1/archive gunicorn -c gunicorn.conf.py app:app
+
+Grabar desde el archivo real las celdas de TIENDAS_MAP (una coordenada por celda; requiere red):
+    python benchmarks/servidor_simulado.py --grabar 2023 2024 [--grabaciones DIR]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CODIGOS_WMO = [0, 1, 2, 3, 45, 51, 53, 61, 63, 80, 95]
+GRABACIONES_POR_DEFECTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grabaciones')
+
+
+def diario_sintetico(lat, lon, fecha_inicio, fecha_fin):
+    """Bloque 'daily' reproducible para una coordenada y rango."""
+    rng = random.Random(f"{lat:.2f},{lon:.2f},{fecha_inicio}")
+    inicio, fin = date.fromisoformat(fecha_inicio), date.fromisoformat(fecha_fin)
+    fechas = [(inicio + timedelta(days=i)).isoformat() for i in range((fin - inicio).days + 1)]
+    base = 32 - abs(lat) * 0.8
+    return {
+        'time': fechas,
+        'weather_code': [rng.choice(CODIGOS_WMO) for _ in fechas],
+        'temperature_2m_max': [round(rng.gauss(base, 2), 1) for _ in fechas],
+        'temperature_2m_min': [round(rng.gauss(base - 10, 1.5), 1) for _ in fechas],
+        'precipitation_sum': [round(rng.expovariate(0.25), 1) if rng.random() < 0.45 else 0.0 for _ in fechas],
+        'wind_speed_10m_max': [round(rng.uniform(3, 30), 1) for _ in fechas],
+    }
+
+
+class Grabaciones:
+    """Respuestas grabadas del archivo real: un JSON por año ({"lat,lon": bloque 'daily'})."""
+
+    def __init__(self, directorio=GRABACIONES_POR_DEFECTO):
+        self.directorio = directorio
+        self._años = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def clave(lat, lon):
+        return f"{round(lat, 5)},{round(lon, 5)}"
+
+    def ruta(self, año):
+        return os.path.join(self.directorio, f"{año}.json")
+
+    def año(self, año):
+        with self._lock:
+            if año not in self._años:
+                try:
+                    with open(self.ruta(año), encoding='utf-8') as archivo:
+                        self._años[año] = json.load(archivo)
+                except FileNotFoundError:
+                    self._años[año] = {}
+            return self._años[año]
+
+    def años_grabados(self):
+        if not os.path.isdir(self.directorio):
+            return []
+        return sorted(int(nombre[:-5]) for nombre in os.listdir(self.directorio)
+                      if nombre.endswith('.json') and nombre[:-5].isdigit())
+
+    def diario(self, lat, lon, fecha_inicio, fecha_fin):
+        """Bloque 'daily' grabado recortado al rango, o None si falta la coordenada en algún año."""
+        partes = []
+        for año in range(int(fecha_inicio[:4]), int(fecha_fin[:4]) + 1):
+            diario = self.año(año).get(self.clave(lat, lon))
+            if diario is None:
+                return None
+            partes.append(diario)
+        unido = {clave: [valor for parte in partes for valor in parte.get(clave) or []] for clave in partes[0]}
+        indices = [i for i, fecha in enumerate(unido['time']) if fecha_inicio <= fecha <= fecha_fin]
+        return {clave: [valores[i] for i in indices if i < len(valores)] for clave, valores in unido.items()}
+
+
+def grabar(años, directorio=GRABACIONES_POR_DEFECTO):
+    """Descarga del archivo real (con el cliente y los lotes de la app) las celdas de TIENDAS_MAP."""
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+
+    os.makedirs(directorio, exist_ok=True)
+    coordenadas = list(app.agrupar_por_celda(app.TIENDAS_MAP))
+    for año in años:
+        rango = app.rango_fechas_año(año)
+        if isinstance(rango, dict):
+            raise SystemExit(f"{año}: {rango['error']}")
+        diarios = {}
+        for inicio in range(0, len(coordenadas), app.ARCHIVO_TAMAÑO_LOTE):
+            lote = coordenadas[inicio:inicio + app.ARCHIVO_TAMAÑO_LOTE]
+            for (lat, lon), diario in zip(lote, app.descargar_diario_lote(lote, *rango)):
+                diarios[Grabaciones.clave(lat, lon)] = diario
+        ruta = Grabaciones(directorio).ruta(año)
+        with open(ruta, 'w', encoding='utf-8') as archivo:
+            json.dump(diarios, archivo, separators=(',', ':'))
+        print(f"{año}: {len(diarios)} coordenadas ({rango[0]} a {rango[1]}) -> {ruta}")
+
+
+class ManejadorArchivo(BaseHTTPRequestHandler):
+    latencia = 0.0
+    peticiones = 0
+    grabaciones = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/v1/archive':
+            self.send_error(404)
+            return
+        type(self).peticiones += 1
+        q = {clave: valores[0] for clave, valores in parse_qs(url.query).items()}
+        try:
+            latitudes = [float(v) for v in q['latitude'].split(',')]
+            longitudes = [float(v) for v in q['longitude'].split(',')]
+            ubicaciones = [self.ubicacion(lat, lon, q['start_date'], q['end_date'])
+                           for lat, lon in zip(latitudes, longitudes)]
+        except (KeyError, ValueError) as e:
+            self.responder(400, {'error': True, 'reason': str(e)})
+            return
+        time.sleep(self.latencia)
+        self.responder(200, ubicaciones[0] if len(ubicaciones) == 1 else ubicaciones)
+
+    def ubicacion(self, lat, lon, fecha_inicio, fecha_fin):
+        diario = self.grabaciones.diario(lat, lon, fecha_inicio, fecha_fin) if self.grabaciones else None
+        if diario is None:
+            diario = diario_sintetico(lat, lon, fecha_inicio, fecha_fin)
+        # Como la API real, devuelve la coordenada de la celda de rejilla (aquí de 0.1°)
+        return {'latitude': round(lat, 1), 'longitude': round(lon, 1), 'daily': diario}
+
+    def responder(self, estado, contenido):
+        cuerpo = json.dumps(contenido).encode('utf-8')
+        self.send_response(estado)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+
+def iniciar(puerto=0, latencia=0.0, manejador=ManejadorArchivo, grabaciones=None):
+    """Arranca el servidor en un hilo y devuelve (servidor, url_del_archivo)."""
+    clase = type('Manejador', (manejador,), {'latencia': latencia, 'grabaciones': grabaciones})
+    servidor = ThreadingHTTPServer(('127.0.0.1', puerto), clase)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_address[1]}/v1/archive"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--puerto', type=int, default=8765)
+    parser.add_argument('--latencia', type=float, default=0.0, help="segundos de espera por respuesta")
+    parser.add_argument('--grabaciones', default=GRABACIONES_POR_DEFECTO, help="directorio de respuestas grabadas")
+    parser.add_argument('--grabar', type=int, nargs='+', metavar='AÑO',
+                        help="grabar estos años del archivo real en lugar de servir")
+    args = parser.parse_args()
+    if args.grabar:
+        grabar(args.grabar, args.grabaciones)
+        return
+    grabaciones = Grabaciones(args.grabaciones)
+    servidor, url = iniciar(args.puerto, args.latencia, grabaciones=grabaciones)
+    print(f"Archivo simulado en {url} (latencia {args.latencia:g} s, años grabados: "
+          f"{grabaciones.años_grabados() or 'ninguno'}). Ctrl+C para terminar.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        servidor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""Suite de benchmarks con el archivo simulado y una línea base guardada.
+
+Levanta el archivo simulado (respuestas grabadas si las hay, si no datos sintéticos) y una
+caché vacía, y mide:
+  - historial: obtener_historial_climatico de las 42 tiendas en frío (archivo) y en caliente (caché)
+  - ranking: calcular_ranking_anual en frío y en caliente
+  - filtros: aplicar_filtros sobre una tienda y sobre las 42 tiendas concatenadas
+  - exportaciones: CSV, XLSX y PDF de una tienda; CSV y PDF masivos de las 42 tiendas
+  - rutas: las rutas Flask bajo carga concurrente (gunicorn con gunicorn.conf.py en otro proceso)
+
+Compara cada caso con benchmarks/baseline.json y termina con código 1 si alguno empeora más
+que la tolerancia. La línea base depende de la máquina y de los parámetros: regénerala con
+--guardar al cambiar de equipo.
+
+Uso:
+    python benchmarks/suite.py [--latencia 0.05] [--concurrencia 16] [--peticiones 64] [--workers 2]
+                               [--solo rutas filtros]
+    python benchmarks/suite.py --guardar
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(DIRECTORIO))
+sys.path.insert(0, DIRECTORIO)
+import servidor_simulado  # noqa: E402
+
+LINEA_BASE_POR_DEFECTO = os.path.join(DIRECTORIO, 'baseline.json')
+# Año cerrado: los datos (grabados o sintéticos) no cambian entre ejecuciones
+AÑO = 2023
+FILTROS_TIPICOS = {'tmax_min': '20', 'precip_max': '10', 'dias_semana': ['0', '1', '2', '3', '4'],
+                   'condiciones_filtro': ['Despejado', 'Llovizna', 'Lluvia Moderada']}
+GRUPOS = ['historial', 'ranking', 'filtros', 'exportaciones', 'rutas']
+
+
+def resumen(tiempos):
+    ordenados = sorted(tiempos)
+    return {'mediana_s': statistics.median(ordenados),
+            'p95_s': ordenados[max(0, math.ceil(len(ordenados) * 0.95) - 1)],
+            'n': len(ordenados)}
+
+
+def cronometrar(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    return resumen(tiempos)
+
+
+def consumir(generador):
+    return sum(len(parte) for parte in generador)
+
+
+def series_año(app, año=AÑO):
+    """Series de todas las tiendas para el año (de la caché si ya se descargaron)."""
+    series = {}
+    for nombre, (lat, lon) in app.TIENDAS_MAP.items():
+        serie = app.obtener_historial_climatico(lat, lon, str(año))
+        if isinstance(serie, dict):
+            raise RuntimeError(f"{nombre}: {serie['error']}")
+        series[nombre] = serie
+    return series
+
+
+def medir_historial(app, args):
+    def pasada():
+        tiempos = []
+        for nombre, (lat, lon) in app.TIENDAS_MAP.items():
+            inicio = time.perf_counter()
+            serie = app.obtener_historial_climatico(lat, lon, str(AÑO))
+            tiempos.append(time.perf_counter() - inicio)
+            if isinstance(serie, dict):
+                raise RuntimeError(f"{nombre}: {serie['error']}")
+        return tiempos
+
+    return {'historial_frio': resumen(pasada()), 'historial_caliente': resumen(pasada())}
+
+
+def medir_ranking(app, args):
+    # Otro año que el del grupo historial, para que la primera pasada vaya al archivo
+    año = AÑO - 1
+
+    def calcular():
+        ranking_data = app.calcular_ranking_anual(app.TIENDAS_MAP, año)
+        if ranking_data['parcial'] or any('error' in fila for fila in ranking_data['ranking']):
+            raise RuntimeError(f"Ranking {año} incompleto")
+
+    return {'ranking_frio': cronometrar(calcular, 1), 'ranking_caliente': cronometrar(calcular, args.repeticiones)}
+
+
+def medir_filtros(app, args):
+    series = list(series_año(app).values())
+    una, todas = series[0], app.SerieClimatica.concatenar(series)
+    filtros = dict(app.filtros_por_defecto(AÑO), **FILTROS_TIPICOS)
+    return {'filtros_1_tienda': cronometrar(lambda: app.aplicar_filtros(una, filtros), args.repeticiones * 20),
+            'filtros_42_tiendas': cronometrar(lambda: app.aplicar_filtros(todas, filtros), args.repeticiones * 5)}
+
+
+def medir_exportaciones(app, args):
+    series = series_año(app)
+    nombre, serie = next(iter(series.items()))
+    secciones = [(tienda, str(AÑO), s) for tienda, s in series.items()]
+    return {
+        'exportar_csv': cronometrar(lambda: consumir(app.generate_csv_rows(serie)), args.repeticiones),
+        'exportar_xlsx': cronometrar(lambda: app.exportar_xlsx_stream(nombre, AÑO, serie).close(), args.repeticiones),
+        'exportar_pdf': cronometrar(
+            lambda: app.generar_pdf_reporte(secciones[:1], titulo="Benchmark").close(), args.repeticiones),
+        'exportar_csv_42': cronometrar(lambda: consumir(app.generar_csv_lote(list(series), [AÑO])), args.repeticiones),
+        'exportar_pdf_42': cronometrar(lambda: app.generar_pdf_reporte(secciones, titulo="Benchmark").close(), 1),
+    }
+
+
+def medir_rutas(app, args):
+    from carga_concurrente import esperar_servidor, puerto_libre
+
+    # Datos y snapshot listos: se mide el servicio de las rutas, no la primera descarga. El
+    # servidor corre en otro proceso (gunicorn.conf.py) para no compartir el GIL con los clientes.
+    app.refrescar_ranking(AÑO)
+    puerto = puerto_libre()
+    entorno = dict(os.environ, PORT=str(puerto), WEB_CONCURRENCY=str(args.workers))
+    proceso = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                               cwd=os.path.dirname(DIRECTORIO), env=entorno,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{puerto}"
+    nombres = list(app.TIENDAS_MAP)
+    try:
+        esperar_servidor(base + '/')
+        pagina = requests.post(base + '/', data={'tienda': nombres[0], 'año_filtro': str(AÑO)}, timeout=60).text
+        resultado_id = re.search(r'name="resultado_id" value="([0-9a-f]+)"', pagina).group(1)
+        casos = {
+            'ruta_historial': lambda i: requests.post(
+                base + '/', data={'tienda': nombres[i % len(nombres)], 'año_filtro': str(AÑO)}, timeout=60),
+            'ruta_ranking': lambda i: requests.get(base + f'/ranking?año={AÑO}', timeout=60),
+            'ruta_api_agregados': lambda i: requests.get(
+                base + f'/api/agregados?periodo=mes&año_desde={AÑO}', timeout=60),
+            'ruta_api_historial': lambda i: requests.get(
+                base + f'/api/historial?tiendas={nombres[i % len(nombres)]}&año_desde={AÑO}', timeout=60),
+            'ruta_exportar_csv': lambda i: requests.post(
+                base + '/exportar_datos/csv', data={'resultado_id': resultado_id}, timeout=60),
+            'ruta_exportar_xlsx': lambda i: requests.post(
+                base + '/exportar_datos/excel', data={'resultado_id': resultado_id}, timeout=60),
+            'ruta_generar_pdf': lambda i: requests.post(
+                base + '/generar_pdf', data={'resultado_id': resultado_id}, timeout=60),
+            'ruta_exportar_lote_csv': lambda i: requests.get(
+                base + f'/exportar_lote/csv?tiendas=todas&año_desde={AÑO}', timeout=120),
+        }
+        # Calentamiento concurrente (todos los workers y, si la ruta cambia de tienda, todas las tiendas)
+        por_tienda = {'ruta_historial', 'ruta_api_historial'}
+        resultados = {}
+        for caso, peticion in casos.items():
+            total = args.peticiones // 4 if caso == 'ruta_exportar_lote_csv' else args.peticiones
+            with ThreadPoolExecutor(max_workers=args.concurrencia) as pool:
+                list(pool.map(peticion, range(len(nombres) if caso in por_tienda else args.concurrencia)))
+
+            def una(i):
+                inicio = time.perf_counter()
+                respuesta = peticion(i)
+                return time.perf_counter() - inicio, respuesta.status_code
+
+            # Se queda la mejor de varias rondas, como timeit: el ruido de la máquina solo suma tiempo
+            rondas = []
+            for _ in range(args.rondas):
+                inicio = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=args.concurrencia) as pool:
+                    medidas = list(pool.map(una, range(total)))
+                duracion = time.perf_counter() - inicio
+                rondas.append(dict(resumen([m[0] for m in medidas]), rps=total / duracion,
+                                   errores=sum(1 for m in medidas if m[1] != 200)))
+            resultados[caso] = max(rondas, key=lambda ronda: ronda['rps'])
+        return resultados
+    finally:
+        proceso.terminate()
+        proceso.wait(timeout=30)
+
+
+MEDICIONES = {'historial': medir_historial, 'ranking': medir_ranking, 'filtros': medir_filtros,
+              'exportaciones': medir_exportaciones, 'rutas': medir_rutas}
+
+
+def comparar(casos, linea_base, tolerancia, margen):
+    """Imprime la tabla de resultados frente a la línea base y devuelve los casos que empeoraron."""
+    base_casos = (linea_base or {}).get('casos', {})
+    regresiones = []
+    print(f"{'caso':<24}{'p50 (s)':>10}{'p95 (s)':>10}{'req/s':>9}{'base p50':>10}{'cambio':>9}")
+    for caso, medida in casos.items():
+        base = base_casos.get(caso)
+        rps = f"{medida['rps']:.1f}" if 'rps' in medida else ''
+        fila = f"{caso:<24}{medida['mediana_s']:>10.4f}{medida['p95_s']:>10.4f}{rps:>9}"
+        if base is None:
+            print(f"{fila}{'-':>10}{'nuevo':>9}")
+            continue
+        cambio = medida['mediana_s'] / base['mediana_s'] - 1 if base['mediana_s'] else 0.0
+        empeora = cambio > tolerancia and medida['mediana_s'] - base['mediana_s'] > margen
+        if 'rps' in medida and 'rps' in base and medida['rps'] < base['rps'] * (1 - tolerancia):
+            empeora = True
+        if medida.get('errores'):
+            empeora = True
+        if empeora:
+            regresiones.append(caso)
+        print(f"{fila}{base['mediana_s']:>10.4f}{cambio:>+8.0%}{' <-' if empeora else ''}")
+    return regresiones
+
+
+def redondear(casos):
+    return {caso: {clave: round(valor, 5) if isinstance(valor, float) else valor for clave, valor in medida.items()}
+            for caso, medida in casos.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latencia', type=float, default=0.05, help="latencia del archivo simulado (s)")
+    parser.add_argument('--concurrencia', type=int, default=16, help="clientes simultáneos en las rutas")
+    parser.add_argument('--peticiones', type=int, default=64, help="peticiones por ruta")
+    parser.add_argument('--workers', type=int, default=2, help="workers de gunicorn para las rutas")
+    parser.add_argument('--rondas', type=int, default=3, help="rondas de carga por ruta (se guarda la mejor)")
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--solo', choices=GRUPOS, nargs='+', help="grupos a medir (por defecto todos)")
+    parser.add_argument('--grabaciones', default=servidor_simulado.GRABACIONES_POR_DEFECTO)
+    parser.add_argument('--linea-base', default=LINEA_BASE_POR_DEFECTO)
+    parser.add_argument('--tolerancia', type=float, default=0.25, help="empeoramiento relativo admitido")
+    parser.add_argument('--margen', type=float, default=0.002, help="diferencia absoluta mínima (s) para avisar")
+    parser.add_argument('--guardar', action='store_true', help="guardar los resultados como nueva línea base")
+    args = parser.parse_args()
+
+    grabaciones = servidor_simulado.Grabaciones(args.grabaciones)
+    servidor, url_archivo = servidor_simulado.iniciar(latencia=args.latencia, grabaciones=grabaciones)
+    with tempfile.TemporaryDirectory() as directorio:
+        # La app lee la URL del archivo y la ruta de la caché al importarse
+        os.environ.update(OPEN_METEO_ARCHIVE_URL=url_archivo, CLIMA_CACHE_DB=os.path.join(directorio, 'cache.sqlite3'),
+                          RANKING_REFRESCO_SEGUNDOS='0')
+        import app
+
+        parametros = {'latencia': args.latencia, 'concurrencia': args.concurrencia, 'peticiones': args.peticiones,
+                      'workers': args.workers, 'rondas': args.rondas, 'repeticiones': args.repeticiones,
+                      'años_grabados': grabaciones.años_grabados()}
+        print(f"Archivo simulado: latencia {args.latencia:g} s, años grabados: "
+              f"{parametros['años_grabados'] or 'ninguno (datos sintéticos)'}")
+        casos = {}
+        for grupo in args.solo or GRUPOS:
+            casos.update(MEDICIONES[grupo](app, args))
+    servidor.shutdown()
+
+    linea_base = None
+    if os.path.exists(args.linea_base):
+        with open(args.linea_base, encoding='utf-8') as archivo:
+            linea_base = json.load(archivo)
+        if linea_base.get('parametros') != parametros:
+            print(f"Aviso: la línea base se midió con otros parámetros: {linea_base.get('parametros')}")
+    regresiones = comparar(casos, linea_base, args.tolerancia, args.margen)
+
+    if args.guardar:
+        casos_guardados = dict((linea_base or {}).get('casos', {}), **redondear(casos))
+        with open(args.linea_base, 'w', encoding='utf-8') as archivo:
+            json.dump({'generado_en': datetime.now().isoformat(timespec='seconds'),
+                       'maquina': {'python': platform.python_version(), 'plataforma': platform.platform(),
+                                   'cpus': os.cpu_count()},
+                       'parametros': parametros, 'casos': casos_guardados}, archivo, indent=2, ensure_ascii=False)
+            archivo.write('\n')
+        print(f"Línea base guardada en {args.linea_base}")
+    elif regresiones:
+        print(f"Regresiones (> {args.tolerancia:.0%}): {', '.join(regresiones)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+"""Configuración de gunicorn (se usa desde el Procfile: gunicorn -c gunicorn.conf.py app:app).
+
+Perfil por defecto: workers 'gthread'. Las rutas que esperan al archivo de Open-Meteo
+(historial, ranking, exportaciones) pasan casi todo el tiempo bloqueadas en red, así que cada
+proceso atiende GUNICORN_THREADS peticiones a la vez en hilos en lugar de una sola. El código
+de la app es seguro entre hilos: conexión SQLite por hilo, sesión HTTP y pool de descargas
+compartidos. ARCHIVO_POOL_CONEXIONES debería ser >= GUNICORN_THREADS para que ningún hilo
+espere por una conexión libre.
+
+Para volver al perfil anterior: GUNICORN_WORKER_CLASS=sync GUNICORN_THREADS=1.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '4'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+# Un ranking en frío o una exportación masiva pueden tardar más que los 30 s por defecto
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '90'))
+keepalive = 5
@@ -0,0 +1,37 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# La caché se abre al importar la app: se apunta a un directorio temporal antes de importarla
+os.environ.setdefault('CLIMA_CACHE_DB', os.path.join(tempfile.mkdtemp(prefix='clima_pruebas_'), 'cache.sqlite3'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as modulo_app  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """La app con una caché SQLite vacía y propia de cada prueba."""
+    monkeypatch.setattr(modulo_app, 'CACHE_DB_PATH', str(tmp_path / 'cache.sqlite3'))
+    monkeypatch.setattr(modulo_app, '_cache_local', modulo_app.threading.local())
+    modulo_app._vuelos_locales.clear()
+    yield modulo_app
+    modulo_app._vuelos_locales.clear()
+
+
+def diario_sintetico(desde, hasta, semilla=0):
+    """Bloque 'daily' con el formato de la API para el rango [desde, hasta]."""
+    import numpy as np
+    fechas = np.arange(np.datetime64(desde), np.datetime64(hasta) + 1)
+    azar = np.random.default_rng(semilla)
+    n = len(fechas)
+    return {
+        'time': np.datetime_as_string(fechas, unit='D').tolist(),
+        'weather_code': azar.integers(0, 4, n).tolist(),
+        'temperature_2m_max': np.round(azar.normal(30, 3, n), 1).tolist(),
+        'temperature_2m_min': np.round(azar.normal(20, 3, n), 1).tolist(),
+        'precipitation_sum': np.round(azar.exponential(2, n), 1).tolist(),
+        'wind_speed_10m_max': np.round(azar.normal(12, 4, n), 1).tolist(),
+    }
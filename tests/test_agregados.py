@@ -0,0 +1,78 @@
+"""Agregados por periodo: paridad con np.nanpercentile y con el calendario ISO de Python."""
+import warnings
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+from conftest import diario_sintetico
+
+
+def _serie(app, desde, hasta, huecos=()):
+    """Serie sintética con NaN en las posiciones de 'huecos' (todas las variables)."""
+    diario = diario_sintetico(desde, hasta, semilla=7)
+    for variable in ('temperature_2m_max', 'temperature_2m_min', 'precipitation_sum', 'wind_speed_10m_max'):
+        for i in huecos:
+            diario[variable][i] = None
+    return app.SerieClimatica.desde_diario(diario)
+
+
+def _esperado(valores, funcion):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # grupos sin datos
+        resultado = float(funcion(valores))
+    return None if np.isnan(resultado) else pytest.approx(resultado, abs=1e-9)
+
+
+@pytest.mark.parametrize('periodo', ['mes', 'semana', 'dia_semana', 'total'])
+def test_estadisticas_coinciden_con_numpy(app, monkeypatch, periodo):
+    # Se compara sin el redondeo a 2 decimales, que puede caer a uno u otro lado en los ...5
+    lista_json = app._lista_json
+    monkeypatch.setattr(app, '_lista_json', lambda valores, decimales=2: lista_json(valores, 12))
+    # Enero entero sin datos: un grupo mensual vacío además de huecos sueltos
+    serie = _serie(app, '2023-01-01', '2023-12-31', huecos=[*range(31), 40, 41, 100, 200, 364])
+    percentiles = [0, 10, 25, 50, 90, 100]
+    agregado = app.agregar_serie(serie, periodo, percentiles)
+    codigos, etiquetas = app.PERIODOS_AGREGADO[periodo](serie.fechas)
+    assert agregado['periodos'] == etiquetas
+
+    for variable in app.VARIABLES_AGREGADO:
+        columna = getattr(serie, variable)
+        for g in range(len(etiquetas)):
+            valores = columna[codigos == g]
+            estadisticas = agregado[variable]
+            assert estadisticas['dias_con_dato'][g] == int(np.sum(~np.isnan(valores)))
+            assert estadisticas['media'][g] == _esperado(valores, np.nanmean)
+            assert estadisticas['min'][g] == _esperado(valores, np.nanmin)
+            assert estadisticas['max'][g] == _esperado(valores, np.nanmax)
+            for p in percentiles:
+                assert estadisticas[f'p{p}'][g] == _esperado(valores, lambda v: np.nanpercentile(v, p)), (g, p)
+
+
+def test_semana_iso_coincide_con_isocalendar(app):
+    # Cruza años en los que la semana 1 empieza en diciembre y otros con semana 53
+    inicio, fin = date(2019, 12, 20), date(2027, 1, 10)
+    fechas = np.arange(np.datetime64(inicio), np.datetime64(fin) + 1)
+    codigos, etiquetas = app._grupos_semana_iso(fechas)
+
+    dias = [inicio + timedelta(days=i) for i in range(len(fechas))]
+    esperadas = ["{}-W{:02d}".format(*dia.isocalendar()[:2]) for dia in dias]
+    assert [etiquetas[c] for c in codigos] == esperadas
+    assert etiquetas == sorted(set(esperadas))
+    assert '2020-W53' in etiquetas and '2026-W53' in etiquetas
+
+
+def test_dia_semana_coincide_con_weekday(app):
+    inicio = date(2024, 2, 26)
+    fechas = np.arange(np.datetime64(inicio), np.datetime64(inicio) + 10)
+    codigos, etiquetas = app._grupos_dia_semana(fechas)
+    esperadas = [app.DIAS_SEMANA_ES[(inicio + timedelta(days=i)).weekday()] for i in range(len(fechas))]
+    assert [etiquetas[c] for c in codigos] == esperadas
+
+
+def test_dias_de_lluvia_y_serie_vacia(app):
+    serie = _serie(app, '2023-03-01', '2023-03-31')
+    agregado = app.agregar_serie(serie, 'mes')
+    assert agregado['dias'] == [31]
+    assert agregado['dias_lluvia'] == [int(np.sum(serie.precipitacion >= app.UMBRAL_DIA_LLUVIOSO_MM))]
+    assert app.agregar_serie(app.SerieClimatica.vacia(), 'mes')['periodos'] == []
@@ -0,0 +1,131 @@
+"""Arrendamientos de descarga (single-flight): liberación ante errores, espera y toma de vencidos."""
+import threading
+import time
+
+import pytest
+
+from conftest import diario_sintetico
+
+COORDENADAS = [(7.06, -73.87), (7.12, -73.12), (6.25, -75.56)]
+
+
+def _vuelos(app, estado=None):
+    consulta = "SELECT clave, estado, expira FROM vuelos"
+    if estado is None:
+        return app._conexion_cache().execute(consulta).fetchall()
+    return app._conexion_cache().execute(consulta + " WHERE estado = ?", (estado,)).fetchall()
+
+
+@pytest.fixture
+def lote(app, monkeypatch):
+    """obtener_historial_lote sin índice de celdas y con un archivo falso que registra las llamadas."""
+    llamadas = []
+
+    def descargar(coordenadas, desde, hasta):
+        llamadas.append(list(coordenadas))
+        return [diario_sintetico(desde, hasta, semilla=i) for i, _ in enumerate(coordenadas)]
+
+    monkeypatch.setattr(app, 'coordenada_archivo', lambda lat, lon: (lat, lon))
+    monkeypatch.setattr(app, 'descargar_diario_lote', descargar)
+    return llamadas
+
+
+def test_lider_que_falla_a_mitad_de_lote_libera_todos_los_arrendamientos(app, lote, monkeypatch):
+    unir = app._unir_diarios
+    uniones = []
+
+    def unir_y_fallar(base, extra):
+        uniones.append(1)
+        if len(uniones) == 2:
+            raise RuntimeError("fallo a mitad de lote")
+        return unir(base, extra)
+
+    monkeypatch.setattr(app, '_unir_diarios', unir_y_fallar)
+    with pytest.raises(RuntimeError):
+        app.obtener_historial_lote(COORDENADAS, 2022)
+
+    assert app._vuelos_locales == {}
+    assert _vuelos(app, 'descargando') == []
+    # Las dos primeras quedaron guardadas antes del fallo; la tercera se puede volver a pedir enseguida
+    claves = [app.clave_vuelo(lat, lon, '2022-01-01', '2022-12-31') for lat, lon in COORDENADAS]
+    assert [app.iniciar_vuelo(clave, esperar=False) for clave in claves] == ['hecho', 'hecho', 'lider']
+
+
+def test_lote_que_no_se_descarga_libera_los_arrendamientos(app, lote, monkeypatch):
+    def descargar(coordenadas, desde, hasta):
+        raise ConnectionError("archivo caído")
+
+    monkeypatch.setattr(app, 'descargar_diario_lote', descargar)
+    resultados = app.obtener_historial_lote(COORDENADAS, 2022)
+
+    assert all(isinstance(resultado, dict) and 'error' in resultado for resultado in resultados)
+    assert app._vuelos_locales == {}
+    assert _vuelos(app) == []
+
+
+def test_lote_correcto_marca_los_rangos_como_revisados(app, lote):
+    resultados = app.obtener_historial_lote(COORDENADAS, 2022)
+
+    assert [len(serie) for serie in resultados] == [365] * len(COORDENADAS)
+    assert len(lote) == 1
+    assert app._vuelos_locales == {}
+    assert {fila[1] for fila in _vuelos(app)} == {'hecho'}
+    # La segunda consulta sale entera de la caché
+    app.obtener_historial_lote(COORDENADAS, 2022)
+    assert len(lote) == 1
+
+
+def test_seguidor_del_mismo_proceso_espera_el_evento_del_lider(app, monkeypatch):
+    clave = app.clave_vuelo(*COORDENADAS[0], '2022-01-01', '2022-12-31')
+    assert app.iniciar_vuelo(clave) == 'lider'
+    assert app.iniciar_vuelo(clave, esperar=False) == 'en_curso'
+
+    # El seguidor del mismo proceso no debe consultar la tabla de vuelos: espera el Event
+    def sin_sondeo():
+        raise AssertionError("el seguidor sondeó la base en lugar de esperar el evento")
+
+    estado = {}
+    seguidor = threading.Thread(target=lambda: estado.setdefault('seguidor', app.iniciar_vuelo(clave)))
+    monkeypatch.setattr(app, '_conexion_cache', sin_sondeo)
+    seguidor.start()
+    seguidor.join(0.3)
+    assert seguidor.is_alive()
+    monkeypatch.undo()
+
+    inicio = time.monotonic()
+    app.terminar_vuelo(clave, True)
+    seguidor.join(5)
+    assert not seguidor.is_alive()
+    assert estado['seguidor'] == 'hecho'
+    assert time.monotonic() - inicio < 1
+    assert app._vuelos_locales == {}
+
+
+def test_arrendamiento_vencido_de_otro_worker_se_retoma(app):
+    clave = app.clave_vuelo(*COORDENADAS[0], '2022-01-01', '2022-12-31')
+    conexion = app._conexion_cache()
+    with conexion:
+        # Un worker que murió a mitad de descarga dejó el arrendamiento sin liberar
+        conexion.execute("INSERT INTO vuelos (clave, estado, expira) VALUES (?, 'descargando', ?)",
+                         (clave, time.time() - 1))
+
+    assert app.iniciar_vuelo(clave, esperar=False) == 'lider'
+    (_, estado, expira), = _vuelos(app)
+    assert estado == 'descargando'
+    assert expira > time.time()
+    app.terminar_vuelo(clave, False)
+    assert _vuelos(app) == []
+
+
+def test_arrendamiento_vigente_de_otro_worker_no_se_toma(app):
+    clave = app.clave_vuelo(*COORDENADAS[0], '2022-01-01', '2022-12-31')
+    conexion = app._conexion_cache()
+    with conexion:
+        conexion.execute("INSERT INTO vuelos (clave, estado, expira) VALUES (?, 'descargando', ?)",
+                         (clave, time.time() + 60))
+
+    assert app.iniciar_vuelo(clave, esperar=False) == 'en_curso'
+    assert clave not in app._vuelos_locales
+    with conexion:
+        conexion.execute("UPDATE vuelos SET estado = 'hecho' WHERE clave = ?", (clave,))
+    assert app.iniciar_vuelo(clave, esperar=False) == 'hecho'